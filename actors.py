@@ -0,0 +1,114 @@
+import collections
+import itertools
+import threading
+import time
+import traceback
+
+from logger import log, DEBUG, ERROR
+from metrics import Histogram
+
+
+class DeviceActor:
+    """
+    One device's command queue, drained in order on an EventLoop. submit()
+    can be called from any thread and never blocks or refuses an intent:
+
+      - an intent with the same key as one still queued replaces it where
+        it stands (latest wins), so a burst of presses is one command
+      - when max_queue intents are waiting the oldest is discarded
+
+    handle(item) sends one intent and returns how many seconds the device
+    will ignore the next one (None if it is ready at once, e.g. the lamp
+    during its fade); what is queued meanwhile waits on a loop timer.
+    discard(item) is told about intents that were replaced or dropped.
+    """
+
+    def __init__(self, name, loop, handle, discard=None, max_queue=8, wait_histogram=None):
+        self.name = name
+        self.loop = loop
+        self.handle = handle
+        self.discard = discard
+        self.max_queue = max_queue
+        self.wait_histogram = wait_histogram if wait_histogram is not None else Histogram()
+        self.submitted = 0
+        self.handled = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_depth = 0
+
+        self._queue = collections.OrderedDict() # key -> (item, queued at)
+        self._lock = threading.Lock()
+        self._scheduled = False # a drain is posted or its timer is pending
+        self._ready_at = 0
+        self._unique = itertools.count()
+
+    def submit(self, key, item):
+        """Queue item under key; key None never coalesces."""
+        if key is None:
+            key = ("unique", next(self._unique))
+        stale = None
+        with self._lock:
+            self.submitted += 1
+            queued = self._queue.get(key)
+            if queued is not None:
+                stale = queued[0]
+                self._queue[key] = (item, queued[1])
+                self.coalesced += 1
+            else:
+                if len(self._queue) >= self.max_queue:
+                    _, (stale, _) = self._queue.popitem(last=False)
+                    self.dropped += 1
+                self._queue[key] = (item, time.monotonic())
+                self.max_depth = max(self.max_depth, len(self._queue))
+            post = not self._scheduled
+            self._scheduled = True
+
+        if stale is not None:
+            log(DEBUG, f"{self.name}: replaced queued {stale}")
+            if self.discard is not None:
+                self.discard(stale)
+        if post:
+            self.loop.call_soon_threadsafe(self._drain)
+
+    def busy(self):
+        return time.monotonic() < self._ready_at
+
+    def _drain(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                if not self._queue:
+                    self._scheduled = False
+                    return
+                if now < self._ready_at:
+                    break
+                key, (item, queued_at) = self._queue.popitem(last=False)
+
+            wait = now - queued_at
+            self.wait_histogram.observe(wait)
+            self.handled += 1
+            try:
+                busy = self.handle(item)
+            except Exception:
+                # the rest of the queue still goes out
+                self.failed += 1
+                log(ERROR, f"{self.name}: sending {item} failed:\n{traceback.format_exc()}")
+                continue
+            if busy:
+                self._ready_at = time.monotonic() + busy
+
+        # still scheduled: the timer drains the rest once the device listens again
+        self.loop.call_at(self._ready_at, self._drain)
+
+    def stats(self):
+        return {"depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "handled": self.handled,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "busy_for": round(max(0, self._ready_at - time.monotonic()), 3),
+                "wait_p50_ms": self.wait_histogram.quantile_ms(0.5),
+                "wait_max_ms": self.wait_histogram.quantile_ms(1)}
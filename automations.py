@@ -0,0 +1,121 @@
+import collections
+import json
+import os
+import time
+
+from logger import log, INFO, WARNING
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+class Automation:
+    """
+    Applies scene at a local time of day, "HH:MM" or "HH:MM:SS", on days
+    (all by default). zones limits it to those zones, None for every zone.
+    only_if_on skips it while a zone is off, so an evening dim does not
+    turn the lights on.
+    """
+
+    __slots__ = ("name", "at", "scene", "days", "zones", "only_if_on", "seconds")
+
+    def __init__(self, name, at, scene, days=None, zones=None, only_if_on=False):
+        parts = [int(p) for p in at.split(":")]
+        if not 2 <= len(parts) <= 3 or not 0 <= parts[0] < 24 or not all(0 <= p < 60 for p in parts[1:]):
+            raise ValueError(f"Bad time {at}, expected HH:MM")
+        unknown = set(days or ()) - set(DAYS)
+        if unknown:
+            raise ValueError(f"Unknown days {sorted(unknown)}, expected some of {DAYS}")
+        self.name = name
+        self.at = at
+        self.scene = scene
+        self.days = tuple(DAYS.index(day) for day in days) if days else tuple(range(7))
+        self.zones = tuple(zones) if zones else None
+        self.only_if_on = only_if_on
+        self.seconds = parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
+
+    def applies_to(self, zone):
+        return self.zones is None or zone in self.zones
+
+    def next_time(self, after):
+        """The first wall clock time after after (epoch seconds) this runs at."""
+        day = time.localtime(after)
+        for offset in range(8):
+            # mktime normalises the day overflow and picks the DST offset of that day
+            t = time.mktime((day.tm_year, day.tm_mon, day.tm_mday + offset, 0, 0, self.seconds, 0, 0, -1))
+            if t > after and time.localtime(t).tm_wday in self.days:
+                return t
+        return None
+
+
+def load_config(path):
+    """
+    Optional automations.json:
+        {"evening": {"at": "21:30", "scene": "EVENING_DIM", "only_if_on": true},
+         "morning": {"at": "06:45", "scene": "MORNING_RAMP", "days": ["mon", "tue", "wed", "thu", "fri"],
+                     "zones": ["bedroom"]}}
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    loaded = []
+    for name, spec in config.items():
+        try:
+            loaded.append(Automation(name, **spec))
+        except (TypeError, ValueError, AttributeError) as e:
+            log(WARNING, f"Skipping automation {name}: {e}")
+    log(INFO, f"Loaded {len(loaded)} automations from {path}")
+    return loaded
+
+
+class AutomationScheduler:
+    """
+    Runs one zone's automations from timers on its EventLoop. The loop's
+    timers run on the monotonic clock, so a wait is never longer than
+    max_wait seconds before it is checked against the wall clock again:
+    a clock stepped by NTP after boot moves the automations with it.
+    """
+
+    def __init__(self, loop, automations, run, max_wait=300):
+        self.loop = loop
+        self.max_wait = max_wait
+        self.automations = automations
+        self.run = run
+        self.history = collections.deque(maxlen=20)
+        self._due = {}
+
+    def start(self):
+        now = time.time()
+        for automation in self.automations:
+            self._arm(automation, now)
+
+    def _arm(self, automation, after):
+        due = automation.next_time(after)
+        if due is None:
+            return
+        self._due[automation.name] = due
+        self._wait(automation, due - time.time())
+
+    def _wait(self, automation, seconds):
+        self.loop.call_later(min(max(0, seconds), self.max_wait), self._fire, automation)
+
+    def _fire(self, automation):
+        now = time.time()
+        due = self._due[automation.name]
+        if now < due:
+            self._wait(automation, due - now)
+            return
+
+        lateness = now - due
+        ran = self.run(automation)
+        self.history.append({"automation": automation.name, "scene": automation.scene, "due": due,
+                             "late_ms": round(lateness * 1000, 1), "ran": ran})
+        log(INFO, f"Automation {automation.name} ({automation.scene}) {'ran' if ran else 'skipped'} "
+                  f"{lateness * 1000:.0f} ms after {automation.at}")
+        self._arm(automation, max(now, due))
+
+    def stats(self):
+        return {"next": {name: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(due))
+                         for name, due in self._due.items()},
+                "recent": list(self.history)}
@@ -0,0 +1,80 @@
+# Brightness lookup tables, computed once at import/startup so the fade path
+# only indexes them: duty tables map percent to PWM duty per output, fade
+# curves map a fade's progress to the fraction of the way to its target.
+
+CURVE_SAMPLES = 1024
+# below this many duty bits a non-linear response has fewer steps at the low
+# end than a linear one, e.g. 8 bit CIE gives duty 1 for everything up to 5%
+MIN_PERCEPTUAL_BITS = 10
+
+
+def cie_lightness(x):
+    """CIE 1931 lightness L* (x = L*/100) to relative luminance."""
+    lightness = x * 100
+    if lightness <= 8:
+        return lightness / 903.3
+    return ((lightness + 16) / 116) ** 3
+
+
+def gamma(x, exponent=2.2):
+    return x ** exponent
+
+
+def ease(p):
+    return p * p * (3 - 2 * p)
+
+
+RESPONSES = {
+    "linear": lambda x: x,
+    "gamma": gamma,
+    "cie": cie_lightness,
+}
+
+
+def _table(fn, samples=CURVE_SAMPLES):
+    return tuple(fn(i / (samples - 1)) for i in range(samples))
+
+# perceptual: even steps of lightness on an output with a linear response
+CURVES = {
+    "linear": _table(lambda p: p),
+    "ease": _table(ease),
+    "perceptual": _table(cie_lightness),
+}
+
+
+def curve_table(name):
+    try:
+        return CURVES[name]
+    except KeyError:
+        raise ValueError(f"Unknown fade curve {name}, expected one of {tuple(CURVES)}") from None
+
+
+def curve_at(table, progress):
+    return table[int(progress * (len(table) - 1) + 0.5)]
+
+
+class DutyTable:
+    """
+    Duty for every brightness step of one output. Any brightness above 0
+    gets at least min_duty so the lowest levels never turn the output off.
+    A response other than linear needs at least MIN_PERCEPTUAL_BITS.
+    """
+
+    def __init__(self, response="linear", bits=8, resolution=10, min_duty=1):
+        if response not in RESPONSES:
+            raise ValueError(f"Unknown response {response}, expected one of {tuple(RESPONSES)}")
+        if response != "linear" and bits < MIN_PERCEPTUAL_BITS:
+            raise ValueError(f"{response} response needs at least {MIN_PERCEPTUAL_BITS} bit duty, got {bits}")
+        self.response = response
+        self.bits = bits
+        self.resolution = resolution
+        self.max_duty = (1 << bits) - 1
+
+        curve = RESPONSES[response]
+        steps = 100 * resolution
+        self.table = tuple(0 if i == 0 else max(min_duty, round(curve(i / steps) * self.max_duty))
+                           for i in range(steps + 1))
+
+    def duty(self, percent):
+        i = round(percent * self.resolution)
+        return self.table[min(max(i, 0), len(self.table) - 1)]
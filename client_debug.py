@@ -1,23 +1,52 @@
+import argparse
+import json
 import socket
-import subprocess
-from varname import nameof
-from client_ips import *
 
-def ping(host, name=None):
-    if name is None:
-        name = host
+# Asks the running leds.py for its client stats. The daemon collects them in
+# the background, so this answers at once.
+#   HEALTH   - probe RTT/loss and up/down state per client
+#   DELIVERY - command ACK latency, retries and failures per device
+#   RX       - receive batches, truncated datagrams and kernel drops
+#   LD2410   - sensor min/max/mean per bucket, e.g. "LD2410 3600 60" for
+#              per-minute buckets over the last hour
+#   PRESENCE - sensor fusion state and time-to-on/time-to-dim latencies
+#   STATS    - counters, gauges and histograms from the metrics registry
+#   RF       - remote codes received and how many were folded into holds
+#   ZONES    - zones, their devices and addresses, power and LED level
+#   SCENES   - recent scenes and how long each device took to converge
+#   AUTOMATIONS - when each time of day scene runs next and how late it ran
+#   TIMERS   - pending timers and how late they ran, per event loop
+#   QUEUES   - per device command queues: depth, coalesced intents, wait time
+# LD2410, PRESENCE, RF, SCENES and AUTOMATIONS take an optional zone name first, e.g.
+# "PRESENCE office"; without one they answer for the RF remote's zone.
+
+def query(host, port, timeout, name="HEALTH"):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    sock.sendto(name.encode(), (host, port))
+    data, addr = sock.recvfrom(65535)
+    return json.loads(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show EllieD client health")
+    parser.add_argument("query", nargs="?", default="HEALTH", choices=("HEALTH", "DELIVERY", "RX", "LD2410", "PRESENCE", "STATS", "RF", "ZONES", "SCENES", "AUTOMATIONS", "TIMERS", "QUEUES"))
+    parser.add_argument("args", nargs="*", help="query arguments")
+    parser.add_argument("--host", default="192.168.50.39")
+    parser.add_argument("--port", type=int, default=2390)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="print the raw JSON")
+    args = parser.parse_args()
+
     try:
-        socket.inet_aton(host)
-    except socket.error:
-        print("IP {host} : {name} is OFFLINE!")
+        stats = query(args.host, args.port, args.timeout, " ".join([args.query] + args.args))
+    except socket.timeout:
+        raise SystemExit(f"No answer from leds.py at {args.host}:{args.port}")
 
-    command = ['ping', '-c', '1', host]
-    result = subprocess.run(command, stdout=subprocess.PIPE)
-    output = result.stdout.decode('utf8')
-    if "Request timed out." in output or "100% packet loss" in output or "Name or service not known" in output:
-        print(f"IP {host} : {name} is OFFLINE!")
+    if args.json or args.query != "HEALTH":
+        print(json.dumps(stats, indent=4))
     else:
-        print(f"IP {host} : {name} is ONLINE!")
-
-for name, ip in CLIENT_IPS.items():
-    ping(ip, name)
+        for name, s in stats.items():
+            state = {True: "ONLINE", False: "OFFLINE", None: "UNKNOWN"}[s["up"]]
+            rtt = s["rtt_ms"]
+            print(f"IP {s['ip']} : {name} is {state} "
+                  f"(rtt p50 {rtt['p50']} ms, p99 {rtt['p99']} ms, loss {s['loss_pct']}%)")
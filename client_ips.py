@@ -6,3 +6,10 @@ CLIENT_IPS = {
     "LAMP_CLIENT_IP"   : "192.168.50.220",
     "LD2410_CLIENT_IP" : "192.168.50.221",
 }
+
+# devices that move around on DHCP, re-resolved by discovery.py
+CLIENT_MACS = {
+    "LAMP"   : "E0:5A:1B:79:8D:88",
+    "MOTION" : "08:B6:1F:81:D8:C4",
+    "LD2410" : "08:B6:1F:81:6D:E0",
+}
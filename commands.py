@@ -0,0 +1,143 @@
+import json
+import os
+import time
+
+from logger import log, INFO, WARNING
+
+
+class RepeatPolicy:
+    """
+    What holding an RF button does (see rfinput.RFDecoder):
+        once   - one command per press, repeats are ignored
+        repeat - the command's hold handler (or the command) runs again
+                 every interval seconds while the button is held
+        ramp   - the hold handler gets "hold" once the press turns into a
+                 hold and "release" when the button is let go
+    """
+    MODES = ("once", "repeat", "ramp")
+
+    __slots__ = ("mode", "interval")
+
+    def __init__(self, mode="once", interval=0.5):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown repeat mode {mode}, expected one of {self.MODES}")
+        self.mode = mode
+        self.interval = interval
+
+ONCE = RepeatPolicy("once")
+
+
+class Command:
+    """
+    One remote/UDP command.
+
+    handler(target, event) performs it and returns the event to give feedback
+    for (normally event itself, or "BAD_INPUT"), or None to abort without
+    sound or persisting. sound(target) picks the feedback sound, None means
+    silent; it is picked after the handler ran, or before it with
+    sound_first, for commands whose sound compares the level they change
+    (BRIGHTNESS_MIN from 1 is bad input). Commands sharing a rate_group
+    share one rate_limit window.
+    repeat is the RepeatPolicy for a held RF button; hold(target, event,
+    phase) handles its "repeat"/"hold"/"release" phases.
+    """
+
+    __slots__ = ("name", "handler", "sound", "kind", "rate_limit", "rate_group", "persist", "rf_codes",
+                 "repeat", "hold", "sound_first", "count", "rejected", "total_time", "max_time")
+
+    def __init__(self, name, handler, sound=None, kind="remote", rate_limit=0, rate_group=None,
+                 persist=False, rf_codes=(), repeat=ONCE, hold=None, sound_first=False):
+        self.name = name
+        self.kind = kind
+        self.handler = handler
+        self.sound = sound
+        self.rate_limit = rate_limit
+        self.rate_group = rate_group or name
+        self.persist = persist
+        self.rf_codes = tuple(rf_codes)
+        self.repeat = repeat
+        self.hold = hold
+        self.sound_first = sound_first
+        self.count = 0
+        self.rejected = 0
+        self.total_time = 0
+        self.max_time = 0
+
+
+class CommandRegistry:
+    def __init__(self):
+        self.commands = {}
+        self.rf_codes = {}
+        self._last_run = {}
+
+    def add(self, command):
+        self.commands[command.name] = command
+        for code in command.rf_codes:
+            self.rf_codes[code] = command
+        return command
+
+    def get(self, token):
+        return self.commands.get(token)
+
+    def from_rf(self, code):
+        return self.rf_codes.get(code)
+
+    def load_config(self, path):
+        """
+        Optional JSON overrides:
+            {"rf_codes":    {"59155": "DELAY_3H"},
+             "aliases":     {"LIGHTS": "POWER_BUTTON"},
+             "rate_limits": {"BRIGHTNESS_UP": 0.1},
+             "repeat":      {"VOLUME_UP": {"mode": "repeat", "interval": 0.2}}}
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+        for code, name in config.get("rf_codes", {}).items():
+            if name in self.commands:
+                self.rf_codes[int(code)] = self.commands[name]
+            else:
+                log(WARNING, f"RF code {code} maps to unknown command {name}")
+        for alias, name in config.get("aliases", {}).items():
+            if name in self.commands:
+                self.commands[alias] = self.commands[name]
+            else:
+                log(WARNING, f"Alias {alias} maps to unknown command {name}")
+        for name, limit in config.get("rate_limits", {}).items():
+            if name in self.commands:
+                self.commands[name].rate_limit = float(limit)
+        for name, policy in config.get("repeat", {}).items():
+            if name in self.commands:
+                self.commands[name].repeat = RepeatPolicy(**policy)
+            else:
+                log(WARNING, f"Repeat policy for unknown command {name}")
+        log(INFO, f"Loaded command config {path}")
+
+    def allow(self, command, now=None, scope=None):
+        """Rate limit per rate_group; each scope (zone) has its own windows."""
+        if now is None:
+            now = time.monotonic()
+        key = (scope, command.rate_group)
+        if now - self._last_run.get(key, -command.rate_limit) < command.rate_limit:
+            command.rejected += 1
+            return False
+        self._last_run[key] = now
+        return True
+
+    def dispatch(self, command, target, event):
+        start = time.perf_counter()
+        result = command.handler(target, event)
+        duration = time.perf_counter() - start
+        command.count += 1
+        command.total_time += duration
+        command.max_time = max(command.max_time, duration)
+        return result
+
+    def stats(self):
+        return {c.name: {"count": c.count,
+                         "rejected": c.rejected,
+                         "mean_ms": round(c.total_time / c.count * 1000, 3) if c.count else 0,
+                         "max_ms": round(c.max_time * 1000, 3)}
+                for c in self.commands.values()}
@@ -0,0 +1,259 @@
+import collections
+import itertools
+import threading
+import time
+
+from logger import log, DEBUG, WARNING
+
+
+class Pending:
+    __slots__ = ("seq", "cmd", "key", "first_sent", "last_sent", "tries", "on_ack", "timer")
+
+    def __init__(self, seq, cmd, key, now, on_ack=None):
+        self.seq = seq
+        self.cmd = cmd
+        self.key = key
+        self.first_sent = now
+        self.last_sent = now
+        self.tries = 1
+        self.on_ack = on_ack
+        self.timer = None # retransmit timer, only touched on the loop thread
+
+
+class DeviceChannel:
+    """
+    Outstanding commands and RTT estimate for one device (RFC 6298 style
+    srtt/rttvar). Commands with the same key supersede each other, so only
+    the newest brightness/fan/light command is ever retried.
+    """
+
+    def __init__(self, name, ip, port, tag_seq=False, min_rto=0.05, max_rto=2.0):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.tag_seq = tag_seq
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.rto = 0.3
+        self.acks_seen = False
+        self.failures_in_row = 0
+
+        self.outstanding = collections.OrderedDict() # seq -> Pending, oldest first
+        self.by_key = {}
+        # bare ACKs still due for superseded commands; they come before the
+        # answer to anything outstanding
+        self.owed_acks = 0
+
+        self.sent = 0
+        self.acked = 0
+        self.retries = 0
+        self.failed = 0
+        self.superseded = 0
+        self.latencies = collections.deque(maxlen=200)
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2) if latencies else None
+
+        return {"ip": self.ip,
+                "sent": self.sent,
+                "acked": self.acked,
+                "retries": self.retries,
+                "failed": self.failed,
+                "superseded": self.superseded,
+                "outstanding": len(self.outstanding),
+                "owed_acks": self.owed_acks,
+                "rto_ms": round(self.rto * 1000, 1),
+                "srtt_ms": round(self.srtt * 1000, 2) if self.srtt is not None else None,
+                "latency_ms": {"p50": pct(0.5), "p99": pct(0.99)}}
+
+
+class Delivery:
+    """
+    Acknowledged command delivery over the shared UDP socket.
+
+    Every command gets a sequence number. Devices created with tag_seq send
+    "<cmd> #<seq>" and must answer "ACK <seq>"; the current firmware answers
+    a bare "ACK", which is matched to the oldest outstanding command for that
+    device once the ACKs owed to commands superseded while unanswered have
+    been used up. Unanswered commands are resent after the device's RTO, doubling
+    on each retry, up to max_retries. A device that has never answered is
+    treated as fire-and-forget after a few failures so it is not flooded.
+
+    send() may be called from any thread; retries run on the EventLoop.
+    on_ack(acked) is called once per command, on the EventLoop: True when it
+    is acknowledged, False when it is given up on or superseded, None at
+    once for a device that is not tracked.
+    """
+
+    def __init__(self, sock, loop, max_retries=4, give_up_after=3):
+        self.sock = sock
+        self.loop = loop
+        self.max_retries = max_retries
+        self.give_up_after = give_up_after
+        self.channels = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def channel(self, name, ip, port, **kwargs):
+        dropped = ()
+        with self._lock:
+            channel = self.channels.get(name)
+            if channel is None:
+                channel = self.channels[name] = DeviceChannel(name, ip, port, **kwargs)
+            elif channel.ip != ip:
+                # commands to the old address will never be acknowledged
+                channel.ip = ip
+                dropped = list(channel.outstanding.values())
+                channel.outstanding.clear()
+                channel.by_key.clear()
+                channel.owed_acks = 0
+        for pending in dropped:
+            self.loop.call_soon_threadsafe(self._disarm, pending)
+            if pending.on_ack is not None:
+                self.loop.call_soon_threadsafe(pending.on_ack, False)
+        return channel
+
+    def send(self, name, ip, port, cmd, key=None, on_ack=None):
+        channel = self.channel(name, ip, port)
+        now = time.monotonic()
+        superseded = None
+        with self._lock:
+            seq = next(self._seq)
+            if key is not None:
+                old = channel.by_key.pop(key, None)
+                if old is not None:
+                    superseded = channel.outstanding.pop(old, None)
+                    if superseded is not None:
+                        channel.superseded += 1
+                        if not channel.tag_seq:
+                            # every copy sent may still be answered
+                            channel.owed_acks += superseded.tries
+                channel.by_key[key] = seq
+
+            tracked = channel.acks_seen or channel.failures_in_row < self.give_up_after
+            if tracked:
+                channel.outstanding[seq] = Pending(seq, cmd, key, now, on_ack)
+            channel.sent += 1
+            rto = channel.rto
+
+        self._transmit(channel, seq, cmd)
+        if superseded is not None:
+            self.loop.call_soon_threadsafe(self._disarm, superseded)
+            if superseded.on_ack is not None:
+                self.loop.call_soon_threadsafe(superseded.on_ack, False)
+        if tracked:
+            self.loop.call_soon_threadsafe(self._arm, channel, seq, rto)
+        elif on_ack is not None:
+            self.loop.call_soon_threadsafe(on_ack, None)
+        return seq
+
+    def _transmit(self, channel, seq, cmd):
+        if channel.tag_seq:
+            cmd = f"{cmd} #{seq}"
+        try:
+            self.sock.sendto(cmd.encode(), (channel.ip, channel.port))
+        except OSError as e:
+            log(DEBUG, f"Send to {channel.name} {channel.ip} failed: {e}")
+
+    def _arm(self, channel, seq, rto):
+        with self._lock:
+            pending = channel.outstanding.get(seq)
+        if pending is not None:
+            pending.timer = self.loop.call_later(rto, self._retry, channel, seq)
+
+    def _disarm(self, pending):
+        if pending.timer is not None:
+            pending.timer.cancel()
+            pending.timer = None
+
+    def _retry(self, channel, seq):
+        with self._lock:
+            pending = channel.outstanding.get(seq)
+            if pending is None:
+                return # acked or superseded
+            give_up = pending.tries > self.max_retries
+            if give_up:
+                del channel.outstanding[seq]
+                if channel.by_key.get(pending.key) == seq:
+                    del channel.by_key[pending.key]
+                channel.failed += 1
+                channel.failures_in_row += 1
+            else:
+                pending.tries += 1
+                pending.last_sent = time.monotonic()
+                channel.retries += 1
+                # exponential backoff on top of the measured RTO
+                rto = min(channel.max_rto, channel.rto * 2 ** (pending.tries - 1))
+
+        if give_up:
+            log(WARNING, f"{channel.name} never acknowledged {pending.cmd}")
+            if pending.on_ack is not None:
+                pending.on_ack(False)
+            return
+
+        log(DEBUG, f"Resending {pending.cmd} to {channel.name} (try {pending.tries})")
+        self._transmit(channel, seq, pending.cmd)
+        pending.timer = self.loop.call_later(rto, self._retry, channel, seq)
+
+    def handle_ack(self, ip, text="ACK"):
+        """Match an ACK from ip. Returns True if it acknowledged a command."""
+        parts = text.split()
+        seq = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+        now = time.monotonic()
+        with self._lock:
+            for channel in self.channels.values():
+                if channel.ip != ip:
+                    continue
+                if seq is None and channel.owed_acks:
+                    # a late answer to a superseded command: the device is
+                    # alive, but this says nothing about the newest one and
+                    # its time is no RTT sample
+                    channel.owed_acks -= 1
+                    channel.acks_seen = True
+                    channel.failures_in_row = 0
+                    return False
+                if not channel.outstanding:
+                    continue
+                match = seq if seq is not None else next(iter(channel.outstanding))
+                pending = channel.outstanding.pop(match, None)
+                if pending is None:
+                    continue
+                if channel.by_key.get(pending.key) == match:
+                    del channel.by_key[pending.key]
+
+                channel.acks_seen = True
+                channel.failures_in_row = 0
+                channel.acked += 1
+                channel.latencies.append(now - pending.first_sent)
+                if pending.tries == 1:
+                    # Karn: only time commands that were sent once
+                    channel.sample_rtt(now - pending.last_sent)
+                elif seq is None:
+                    # the other copies may be answered too
+                    channel.owed_acks += pending.tries - 1
+                break
+            else:
+                return False
+
+        self._disarm(pending)
+        if pending.on_ack is not None:
+            pending.on_ack(True)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {name: channel.stats() for name, channel in self.channels.items()}
@@ -0,0 +1,123 @@
+import subprocess
+import threading
+import time
+
+from logger import log, DEBUG, INFO, WARNING
+
+ARP_TABLE = "/proc/net/arp"
+ARP_FLAG_COMPLETE = 0x2
+
+
+def read_arp_table(path=ARP_TABLE):
+    """MAC -> IP from the kernel neighbour table, complete entries only."""
+    table = {}
+    try:
+        with open(path, 'r') as f:
+            next(f) # header
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                ip, flags, mac = fields[0], int(fields[2], 16), fields[3].lower()
+                if flags & ARP_FLAG_COMPLETE and mac != "00:00:00:00:00:00":
+                    table[mac] = ip
+    except (OSError, StopIteration, ValueError) as e:
+        log(WARNING, f"Could not read {path}: {e}")
+    return table
+
+
+def arp_scan(interface=None, timeout=15):
+    """MAC -> IP for every host answering a single arp-scan of the local net."""
+    cmd = ["arp-scan", "--localnet", "--quiet", "--plain"]
+    if interface is not None:
+        cmd.append(f"--interface={interface}")
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log(WARNING, f"arp-scan failed: {e}")
+        return {}
+
+    table = {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].count(".") == 3:
+            table[fields[1].lower()] = fields[0]
+    return table
+
+
+class ClientDiscovery:
+    """
+    Resolves all known client MACs at once: first from the kernel ARP table,
+    then with one arp-scan for whatever is still missing. Results are cached
+    for ttl seconds. refresh_async() re-resolves on a background thread and
+    reports changed addresses through on_change(name, ip).
+    """
+
+    def __init__(self, macs, ttl=300, interface=None, on_change=None):
+        self.macs = {name: mac.lower() for name, mac in macs.items()}
+        self.ttl = ttl
+        self.interface = interface
+        self.on_change = on_change
+        self.scans = 0
+
+        self._lock = threading.Lock()
+        self._cache = {} # name -> (ip, resolved_at)
+        self._refreshing = False
+
+    def lookup(self, name):
+        with self._lock:
+            entry = self._cache.get(name)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def expired(self):
+        now = time.monotonic()
+        with self._lock:
+            return any(name not in self._cache or now - self._cache[name][1] > self.ttl
+                       for name in self.macs)
+
+    def resolve_all(self, scan=True):
+        table = read_arp_table()
+        if scan and any(mac not in table for mac in self.macs.values()):
+            self.scans += 1
+            table.update(arp_scan(self.interface))
+
+        now = time.monotonic()
+        changed = {}
+        with self._lock:
+            for name, mac in self.macs.items():
+                ip = table.get(mac)
+                if ip is None:
+                    continue
+                old = self._cache.get(name)
+                if old is None or old[0] != ip:
+                    changed[name] = ip
+                self._cache[name] = (ip, now)
+
+        missing = [name for name, mac in self.macs.items() if mac not in table]
+        if missing and scan:
+            log(WARNING, f"No device found for {', '.join(missing)}")
+
+        for name, ip in changed.items():
+            log(INFO, f"{name} [{self.macs[name]}] : {ip}")
+            if self.on_change is not None:
+                self.on_change(name, ip)
+        return {name: entry[0] for name, entry in self._cache.items()}
+
+    def refresh_async(self, reason=""):
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+
+        log(DEBUG, f"Re-resolving client addresses {reason}")
+        threading.Thread(target=self._refresh, name="discovery", daemon=True).start()
+        return True
+
+    def _refresh(self):
+        try:
+            self.resolve_all()
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,187 @@
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import time
+import traceback
+
+from logger import log, ERROR
+
+
+class TimerHandle:
+    """
+    A timer on an EventLoop, returned by call_later/call_at/call_every.
+    cancel() and reschedule() are O(log n) and, like scheduling, must be
+    called from the loop thread.
+    """
+    __slots__ = ("loop", "deadline", "callback", "args", "_entry")
+
+    def __init__(self, loop, callback, args):
+        self.loop = loop
+        self.deadline = None
+        self.callback = callback
+        self.args = args
+        self._entry = None
+
+    def active(self):
+        return self._entry is not None
+
+    def cancel(self):
+        if self._entry is not None:
+            self.loop._discard(self._entry)
+            self._entry = None
+
+    def reschedule(self, delay):
+        self.reschedule_at(time.monotonic() + delay)
+
+    def reschedule_at(self, deadline):
+        self.cancel()
+        self.deadline = deadline
+        self._entry = self.loop._push(deadline, self)
+
+
+class EventLoop:
+    """
+    Single threaded selector loop. Sleeps until a registered socket is
+    readable, a callback is posted from another thread (RF ISR) or the
+    next timer is due.
+
+    Timers are kept in a heap on the monotonic clock. A cancelled timer is
+    only marked dead in it and skipped when it comes up; the heap is
+    rebuilt once most of it is dead. How late each timer ran is kept in
+    lateness (and the optional histogram).
+
+    An exception in a callback is logged and counted in errors; the loop
+    keeps running, so one bad handler cannot stop every later event.
+
+    add_reader/call_later/call_every must be called from the loop thread
+    (or before run()). Other threads use call_soon_threadsafe.
+    """
+
+    def __init__(self, lateness_histogram=None):
+        self._selector = selectors.DefaultSelector()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._dead_timers = 0
+        self._pending = collections.deque()
+        self._running = False
+        self.iterations = 0
+        self.errors = 0
+        self.timers_run = 0
+        self.lateness = collections.deque(maxlen=200)
+        self.lateness_histogram = lateness_histogram
+
+        # self-pipe so call_soon_threadsafe can interrupt select()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.add_reader(self._wake_r, self._drain_wakeup)
+
+    def add_reader(self, fileobj, callback, *args):
+        self._selector.register(fileobj, selectors.EVENT_READ, (callback, args))
+
+    def remove_reader(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._pending.append((callback, args))
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass # a wakeup is already queued
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        handle = TimerHandle(self, callback, args)
+        handle.reschedule_at(deadline)
+        return handle
+
+    def call_every(self, interval, callback, *args):
+        """Runs callback every interval seconds until the returned handle is cancelled."""
+        def tick():
+            # on the original grid, skipping ticks that were missed entirely
+            handle.reschedule_at(max(handle.deadline + interval, time.monotonic()))
+            callback(*args)
+        handle = self.call_later(interval, tick)
+        return handle
+
+    def timer_stats(self):
+        lateness = sorted(self.lateness)
+        return {"scheduled": len(self._timers) - self._dead_timers,
+                "run": self.timers_run,
+                "lateness_p50_ms": round(lateness[len(lateness) // 2] * 1000, 2) if lateness else None,
+                "lateness_max_ms": round(lateness[-1] * 1000, 2) if lateness else None}
+
+    def _push(self, deadline, handle):
+        entry = [deadline, next(self._timer_seq), handle]
+        heapq.heappush(self._timers, entry)
+        return entry
+
+    def _discard(self, entry):
+        entry[2] = None
+        self._dead_timers += 1
+        if self._dead_timers > 64 and self._dead_timers > len(self._timers) // 2:
+            self._timers = [e for e in self._timers if e[2] is not None]
+            heapq.heapify(self._timers)
+            self._dead_timers = 0
+
+    def stop(self):
+        self._running = False
+        self.call_soon_threadsafe(lambda: None)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _timeout(self):
+        if self._pending:
+            return 0
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+            self._dead_timers -= 1
+        if self._timers:
+            return max(0, self._timers[0][0] - time.monotonic())
+        return None
+
+    def _ran_late(self, lateness):
+        self.timers_run += 1
+        self.lateness.append(lateness)
+        if self.lateness_histogram is not None:
+            self.lateness_histogram.observe(lateness)
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            self.errors += 1
+            name = getattr(callback, "__qualname__", repr(callback))
+            log(ERROR, f"Event loop callback {name} failed:\n{traceback.format_exc()}")
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.iterations += 1
+            for key, mask in self._selector.select(self._timeout()):
+                callback, args = key.data
+                self._call(callback, args)
+
+            # deque.popleft is atomic, so no lock is needed against the ISR thread
+            while self._pending:
+                callback, args = self._pending.popleft()
+                self._call(callback, args)
+
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                deadline, seq, handle = heapq.heappop(self._timers)
+                if handle is None:
+                    self._dead_timers -= 1
+                    continue
+                handle._entry = None
+                self._ran_late(time.monotonic() - deadline)
+                self._call(handle.callback, handle.args)
@@ -0,0 +1,181 @@
+import math
+import threading
+import time
+import traceback
+
+from brightness import curve_at, curve_table
+from logger import log, INFO, ERROR
+
+
+class Fader:
+    """
+    Fade engine for one output. A single thread computes the level for each
+    frame from the monotonic clock, so the time spent sending a frame does not
+    stretch the fade. Frames that are already in the past are skipped rather
+    than played late, and fade_to() retargets an in-flight fade immediately,
+    starting from wherever the current fade has got to.
+
+    Levels are issued in steps of 1/resolution, and only when the step
+    changes. The shape of a fade comes from a precomputed curve table
+    (brightness.CURVES) indexed by its progress.
+    """
+
+    def __init__(self, name, on_frame, value=0, fps=50, resolution=1):
+        self.name = name
+        self.on_frame = on_frame
+        self.fps = fps
+        self.resolution = resolution
+        self.frames = 0
+        self.skipped_frames = 0
+        self.errors = 0
+        self.last_duration = None
+
+        self._cond = threading.Condition()
+        self._value = value
+        self._last_out = round(value * resolution)
+        self._start_value = value
+        self._target = value
+        self._start_t = 0
+        self._duration = 0
+        self._curve = curve_table("linear")
+        self._active = False
+        self._on_done = None
+        self._frame_cb = on_frame
+        self._generation = 0
+
+        self._thread = threading.Thread(target=self._run, name=f"fader-{name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def value(self):
+        with self._cond:
+            if self._active:
+                return self._level_at(time.monotonic())
+            return self._value
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def remaining(self):
+        """Seconds left in the current fade, 0 when idle."""
+        with self._cond:
+            if not self._active:
+                return 0
+            return max(0, self._start_t + self._duration - time.monotonic())
+
+    def fade_to(self, target, duration, on_done=None, on_frame=None, start_at=None, curve="linear"):
+        """
+        Start fading to target over duration seconds. Returns the level the
+        fade starts from. on_done(achieved_seconds) is called when the final
+        frame has been sent, or on_done(None) when the fade is retargeted or
+        stopped first. on_frame
+        overrides the output callback for this fade only, e.g. to just track
+        the level while the client runs the fade itself. start_at is the
+        monotonic start of the fade's timeline, so fades on several outputs
+        can share one; default now. curve names a brightness.CURVES table.
+        """
+        table = curve_table(curve)
+        with self._cond:
+            replaced = self._on_done
+            self._frame_cb = on_frame or self.on_frame
+            now = time.monotonic() if start_at is None else start_at
+            if self._active:
+                self._value = self._level_at(now)
+            self._start_value = self._value
+            self._target = target
+            self._start_t = now
+            self._duration = max(0, duration)
+            self._curve = table
+            self._on_done = on_done
+            self._active = True
+            self._generation += 1
+            self._cond.notify()
+            start = self._start_value
+        if replaced is not None:
+            replaced(None)
+        return start
+
+    def stop(self):
+        """Freeze at the current level."""
+        with self._cond:
+            replaced = self._on_done
+            self._on_done = None
+            if self._active:
+                self._value = self._level_at(time.monotonic())
+                self._target = self._value
+                self._active = False
+                self._generation += 1
+                self._cond.notify()
+            value = self._value
+        if replaced is not None:
+            replaced(None)
+        return value
+
+    def _level_at(self, now):
+        if self._duration <= 0:
+            return self._target
+        progress = min(1, max(0, (now - self._start_t) / self._duration))
+        return self._start_value + (self._target - self._start_value) * curve_at(self._curve, progress)
+
+    def _call(self, callback, arg):
+        # a failed send or callback must not end the fade thread
+        try:
+            callback(arg)
+        except Exception:
+            self.errors += 1
+            name = getattr(callback, "__qualname__", repr(callback))
+            log(ERROR, f"[{self.name}] fade callback {name} failed:\n{traceback.format_exc()}")
+
+    def _run(self):
+        frame = 1 / self.fps
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+
+                now = time.monotonic()
+                generation = self._generation
+                start_t = self._start_t
+                end_t = start_t + self._duration
+                level = self._level_at(now)
+                done = now >= end_t
+                if done:
+                    self._value = self._target
+                    self._active = False
+                    on_done = self._on_done
+                    self._on_done = None
+                frame_cb = self._frame_cb
+
+            step = round(level * self.resolution)
+            out = step if self.resolution == 1 else step / self.resolution
+            if step != self._last_out:
+                self._last_out = step
+                self.frames += 1
+                self._call(frame_cb, out)
+
+            if done:
+                # time at which the final level was issued
+                self.last_duration = now - start_t
+                log(INFO, f"[{self.name}] fade to {out} done in {self.last_duration:.3f}s "
+                          f"(requested {end_t - start_t:.3f}s, skipped {self.skipped_frames} frames)")
+                if on_done is not None:
+                    self._call(on_done, self.last_duration)
+                continue
+
+            # next frame on the fade's own timeline, never past the end
+            sent = time.monotonic()
+            index = math.floor((sent - start_t) / frame) + 1
+            expected = math.floor((now - start_t) / frame) + 1
+            if index > expected:
+                self.skipped_frames += index - expected
+            next_t = min(start_t + index * frame, end_t)
+
+            with self._cond:
+                if self._generation == generation:
+                    self._cond.wait(max(0, next_t - time.monotonic()))
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+"""
+Local UDP stand-ins for the ESP clients so the leds.py protocol can be
+exercised without hardware. Point the matching entry in client_ips.py at
+the address the fake listens on.
+
+    python3 fake_clients.py pwm --bind 127.0.0.1 --port 2390
+    python3 fake_clients.py pwm --legacy      # firmware without FADE
+    python3 fake_clients.py pwm --bits 12     # 12 bit duty, see "bits" in zones.json
+    python3 fake_clients.py lamp --bind 127.0.0.3
+    python3 fake_clients.py ir --bind 127.0.0.4
+"""
+import argparse
+import socket
+import threading
+import time
+
+# the daemon's own curve tables, so the fake runs every curve it can ask for
+from brightness import CURVES, curve_at
+
+
+class FakeClient:
+    def __init__(self, name, bind="127.0.0.1", port=2390, verbose=False):
+        self.name = name
+        self.verbose = verbose
+        self.received = []
+        self.arrived = threading.Condition() # notified on every datagram
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((bind, port))
+        self.address = self.sock.getsockname()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"fake-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+    def reply(self, text, addr):
+        self.sock.sendto(text.encode(), addr)
+
+    def _run(self):
+        while self._running:
+            try:
+                data, addr = self.sock.recvfrom(256)
+            except OSError:
+                return
+            cmd = data.decode('ascii').strip()
+            with self.arrived:
+                self.received.append((time.monotonic(), cmd))
+                self.arrived.notify_all()
+            if cmd == "ACK":
+                continue
+            if self.verbose:
+                print(f"[{self.name}] {cmd}")
+            try:
+                self.reply("ACK", addr)
+                self.handle(cmd, addr)
+            except OSError:
+                if self._running:
+                    raise
+                return # stopped while handling this one
+
+    def handle(self, cmd, addr):
+        pass
+
+
+class FakePWMClient(FakeClient):
+    """
+    Understands "^SET_PWM <duty>$", and unless legacy is set, "^CAPS$" and
+    "^FADE <start> <end> <ms> <curve>$". duty_at() evaluates running fades
+    the way the firmware would.
+    """
+
+    def __init__(self, legacy=False, bits=8, **kwargs):
+        super().__init__("PWM", **kwargs)
+        self.legacy = legacy
+        self.bits = bits
+        self.max_duty = (1 << bits) - 1
+        self.duty = 0
+        self.fade = None
+        self.history = []
+
+    def handle(self, cmd, addr):
+        if not (cmd.startswith("^") and cmd.endswith("$")):
+            return
+        parts = cmd[1:-1].split()
+        now = time.monotonic()
+
+        if parts[0] == "SET_PWM":
+            self.fade = None
+            self._set(now, int(parts[1]))
+        elif parts[0] == "CAPS" and not self.legacy:
+            self.reply(f"CAPS FADE BITS={self.bits} " + " ".join(CURVES), addr)
+        elif parts[0] == "FADE" and not self.legacy:
+            start, end, ms = int(parts[1]), int(parts[2]), int(parts[3])
+            curve = CURVES.get(parts[4] if len(parts) > 4 else "linear", CURVES["linear"])
+            self.fade = (now, start, end, ms / 1000, curve)
+            self._set(now, start)
+
+    def duty_at(self, now=None):
+        if self.fade is None:
+            return self.duty
+        if now is None:
+            now = time.monotonic()
+        t0, start, end, duration, curve = self.fade
+        p = 1 if duration <= 0 else min(1, (now - t0) / duration)
+        return round(start + (end - start) * curve_at(curve, p))
+
+    def _set(self, now, duty):
+        self.duty = max(0, min(self.max_duty, duty))
+        self.history.append((now, self.duty))
+        if self.verbose:
+            print(f"[{self.name}] duty = {self.duty}")
+
+
+class FakeLampClient(FakeClient):
+    """Understands "LAMPSET <seconds> <level>"."""
+
+    def __init__(self, **kwargs):
+        super().__init__("LAMP", **kwargs)
+        self.level = 0
+        self.history = []
+
+    def handle(self, cmd, addr):
+        parts = cmd.split()
+        if len(parts) == 3 and parts[0] == "LAMPSET":
+            self.level = int(parts[2])
+            self.history.append((time.monotonic(), int(parts[1]), self.level))
+            if self.verbose:
+                print(f"[{self.name}] level = {self.level} over {parts[1]}s")
+
+
+class FakeIRClient(FakeClient):
+    """Remembers the last IR_LIGHT_* and IR_FAN_* code it was asked to send."""
+
+    def __init__(self, **kwargs):
+        super().__init__("IR", **kwargs)
+        self.light = None
+        self.fan = None
+
+    def handle(self, cmd, addr):
+        if cmd.startswith("IR_LIGHT"):
+            self.light = cmd
+        elif cmd.startswith("IR_FAN"):
+            self.fan = cmd
+
+
+CLIENTS = {
+    "pwm": FakePWMClient,
+    "lamp": FakeLampClient,
+    "ir": FakeIRClient,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake EllieD UDP clients")
+    parser.add_argument("client", choices=CLIENTS)
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2390)
+    parser.add_argument("--legacy", action="store_true", help="PWM firmware without FADE support")
+    parser.add_argument("--bits", type=int, default=8, help="PWM duty resolution")
+    args = parser.parse_args()
+
+    kwargs = {"bind": args.bind, "port": args.port, "verbose": True}
+    if args.client == "pwm":
+        kwargs["legacy"] = args.legacy
+        kwargs["bits"] = args.bits
+    client = CLIENTS[args.client](**kwargs).start()
+    print(f"Fake {args.client} client listening on {client.address}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        client.stop()
@@ -0,0 +1,177 @@
+import collections
+import socket
+import time
+
+from logger import log, DEBUG, INFO, WARNING
+
+RTT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class ClientHealth:
+    """
+    Rolling RTT/loss window for one client. Loss is None in the window.
+    The client is marked down after down_after consecutive losses and up
+    again after up_after consecutive answers.
+    """
+
+    def __init__(self, name, ip, window=100, down_after=3, up_after=2):
+        self.name = name
+        self.ip = ip
+        self.down_after = down_after
+        self.up_after = up_after
+        self.up = None
+        self.sent = 0
+        self.received = 0
+        self.outstanding = None
+        self.last_change = None
+
+        self._window = collections.deque(maxlen=window)
+        self._histogram = [0] * (len(RTT_BUCKETS_MS) + 1) # last bucket is loss
+        self._streak = 0 # >0 answers in a row, <0 losses in a row
+
+    def _bucket(self, rtt):
+        if rtt is None:
+            return len(RTT_BUCKETS_MS)
+        ms = rtt * 1000
+        for i, limit in enumerate(RTT_BUCKETS_MS):
+            if ms <= limit:
+                return i
+        return len(RTT_BUCKETS_MS) - 1
+
+    def record(self, rtt):
+        """rtt in seconds or None for a loss. Returns True/False on an up/down transition."""
+        if len(self._window) == self._window.maxlen:
+            self._histogram[self._bucket(self._window[0])] -= 1
+        self._window.append(rtt)
+        self._histogram[self._bucket(rtt)] += 1
+
+        if rtt is None:
+            self._streak = min(self._streak, 0) - 1
+            if self.up is not False and -self._streak >= self.down_after:
+                return self._set_state(False)
+        else:
+            self.received += 1
+            self._streak = max(self._streak, 0) + 1
+            if self.up is not True and self._streak >= self.up_after:
+                return self._set_state(True)
+        return None
+
+    def _set_state(self, up):
+        self.up = up
+        self.last_change = time.time()
+        return up
+
+    def stats(self):
+        rtts = sorted(r for r in self._window if r is not None)
+        losses = len(self._window) - len(rtts)
+
+        def pct(p):
+            return round(rtts[min(len(rtts) - 1, int(p * len(rtts)))] * 1000, 2) if rtts else None
+
+        labels = [f"<={b}ms" for b in RTT_BUCKETS_MS] + ["lost"]
+        return {"ip": self.ip,
+                "up": self.up,
+                "sent": self.sent,
+                "received": self.received,
+                "loss_pct": round(100 * losses / len(self._window), 1) if self._window else None,
+                "rtt_ms": {"p50": pct(0.5), "p99": pct(0.99),
+                           "mean": round(sum(rtts) / len(rtts) * 1000, 2) if rtts else None},
+                "histogram": dict(zip(labels, self._histogram)),
+                "last_change": self.last_change}
+
+
+class HealthMonitor:
+    """
+    Probes every client at once with an application level "PING" on its own
+    UDP socket and times the "ACK" each client sends back. Runs on the
+    daemon's EventLoop; on_change(name, up) is called on state transitions.
+    """
+
+    def __init__(self, clients, port=2390, interval=10, timeout=1.0, on_change=None):
+        self.port = port
+        self.interval = interval
+        self.timeout = timeout
+        self.on_change = on_change
+        self.clients = {name: ClientHealth(name, ip) for name, ip in clients.items() if ip}
+        self._by_ip = {}
+        self._index()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self._loop = None
+
+    def _index(self):
+        self._by_ip = collections.defaultdict(list)
+        for client in self.clients.values():
+            self._by_ip[client.ip].append(client)
+
+    def set_ip(self, name, ip):
+        # may be called from the discovery thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._set_ip, name, ip)
+        else:
+            self._set_ip(name, ip)
+
+    def _set_ip(self, name, ip):
+        client = self.clients.get(name)
+        if client is None:
+            self.clients[name] = ClientHealth(name, ip)
+        else:
+            client.ip = ip
+            client.outstanding = None
+        self._index()
+
+    def attach(self, loop):
+        self._loop = loop
+        loop.add_reader(self.sock, self._on_readable)
+        loop.call_soon_threadsafe(self.probe_all)
+        loop.call_every(self.interval, self.probe_all)
+
+    def probe_all(self):
+        now = time.monotonic()
+        for ip, clients in self._by_ip.items():
+            try:
+                self.sock.sendto(b"PING", (ip, self.port))
+            except OSError as e:
+                log(DEBUG, f"Health probe to {ip} failed: {e}")
+            for client in clients:
+                client.sent += 1
+                client.outstanding = now
+        self._loop.call_later(self.timeout, self._expire)
+
+    def _expire(self):
+        now = time.monotonic()
+        for client in self.clients.values():
+            if client.outstanding is not None and now - client.outstanding >= self.timeout:
+                client.outstanding = None
+                self._record(client, None)
+
+    def _on_readable(self):
+        now = time.monotonic()
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(64)
+            except BlockingIOError:
+                return
+            except OSError:
+                # ICMP port unreachable from a previous probe
+                continue
+            for client in self._by_ip.get(addr[0], ()):
+                if client.outstanding is not None:
+                    rtt = now - client.outstanding
+                    client.outstanding = None
+                    self._record(client, rtt)
+
+    def _record(self, client, rtt):
+        change = client.record(rtt)
+        if change is None:
+            return
+        if change:
+            log(INFO, f"{client.name} {client.ip} is ONLINE")
+        else:
+            log(WARNING, f"{client.name} {client.ip} is OFFLINE")
+        if self.on_change is not None:
+            self.on_change(client.name, change)
+
+    def stats(self):
+        return {name: client.stats() for name, client in self.clients.items()}
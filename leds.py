@@ -1,89 +1,73 @@
 #!/usr/bin/python3
 import socket
 import time
-import subprocess
 import threading
-import json
 import os
-from collections import defaultdict 
+import json
 import signal
 import sys
-from rpi_rf import RFDevice
-from pathlib import Path
-from datetime import datetime
-import builtins
-import simpleaudio as sa
-import wave
 import atexit
+import _thread
 from client_ips import *
+from actors import DeviceActor
+from automations import AutomationScheduler, load_config as load_automations
+from brightness import DutyTable, MIN_PERCEPTUAL_BITS
+from commands import Command, CommandRegistry, RepeatPolicy
+from delivery import Delivery
+from discovery import ClientDiscovery
+from eventloop import EventLoop
+from fader import Fader
+from health import HealthMonitor
+from logger import DEBUG, INFO, WARNING, ERROR, log
+from metrics import REGISTRY as metrics
+from mixer import make_mixer
+from notifier import Notifier
+from presence import PresenceEngine, Source
+from rfinput import RFDecoder
+from scenes import SAVED, Scene, SceneEngine, SceneRegistry
+from settings import SettingsStore
+from telemetry import SensorRing
+from sounds import SoundBank
+from zones import load_registry
+from logger import configure as configure_logger, level_from_env as log_level_from_env
 
 global test_mode
 test_mode = False
+controller = None
 
-subprocess.call(["/usr/local/bin/join.py", "--text", "'led.py restarted'"])
-play_lock = threading.Lock()
 dir_path = os.path.dirname(os.path.realpath(__file__))
 dir_sounds = os.path.join(dir_path, "sounds")
 log_path = os.path.join(dir_path, "logs")
-#remove old logs except last 10
-os.system("ls -1rt -d -1 /root/EllieD/logs/* | head -n -10 | xargs -d '\n' rm -f --")
-Path(log_path).mkdir(parents=True, exist_ok=True)
-log_time_start = time.time()
+# optional, without it client_ips.py is the only zone
+zones_path = os.path.join(dir_path, "zones.json")
+# node_exporter textfile collector output, rewritten every metrics_interval
+metrics_path = os.environ.get("ELLIED_METRICS_PATH", os.path.join(log_path, "ellied.prom"))
+metrics_interval = 60
+logger = None
+notifier = None
+started_at = None # monotonic time startup began, for time-to-first-event
 
 def round5(x):
     return 5 * round(x/5)
 
-def onClose():
-    subprocess.call(["/usr/local/bin/join.py", "--text", "leds.py crashed"])
-    pass
-
-atexit.register(onClose)
-
-def create_new_log():
-    global logfile_unique
-    logfile_unique = datetime.now().strftime("%Y.%m.%d.%H.%M.%S.log")
-    logfile_unique = os.path.join(log_path, logfile_unique)
-
-create_new_log()
-
-def print(*args, **kwargs):
-    global logfile_unique
-    global log_time_start
-
-    if (time.time() - log_time_start) > 86400:
-        create_new_log()
-        log_time_start = time.time()
-
-    logf = open(logfile_unique, 'a')
-    stamp = datetime.now().strftime("[%Y.%m.%d.%H.%M.%S] ")
-    logf.write(stamp)
-    builtins.print(*args, **kwargs, file=logf)
-    logf.close()
-    sys.stdout.write(stamp)
-    builtins.print(*args, **kwargs)
-
-def find_client_ip(mac):
-    ip = ""
-    cmd = f"arp-scan --destaddr={mac} --localnet | grep 192 | tail -1"
-    try:
-        ip = subprocess.check_output((cmd),shell=True,stderr=subprocess.STDOUT).strip().split()[0].decode("utf-8")
-    except (IndexError, subprocess.CalledProcessError):
-        print(f"No device found with mac: {mac}")
-
-    if "invalid" in ip.lower():
-        return ""
-
-    return ip
-
-def load_wave(path):
-    with wave.open(path, 'rb') as wav_file:
-        audio_data = wav_file.readframes(wav_file.getnframes())
-    return audio_data
+def notify(text):
+    # queued for the notifier thread, never blocks
+    if notifier is not None:
+        notifier.notify(text)
 
+def onClose():
+    notify("leds.py crashed")
+    if notifier is not None:
+        notifier.flush(timeout=2)
+    if controller is not None:
+        for lights in controller.zones.values():
+            lights.settings.flush()
+    if logger is not None:
+        logger.close()
+
+def print(*args, level=INFO, sep=" ", end="\n", **kwargs):
+    log(level, *args, sep=sep, end=end)
 
-led_lock = threading.Lock()
-lamp_lock = threading.Lock()
-lock_fade_request = threading.Lock()
 pwm_pin = 12
 
 class bcolors:
@@ -102,12 +86,14 @@ class Timer(object):
     def __init__(self, name, min_time=0):
         self.name = name
         self.min_time = min_time
+        self.histogram = metrics.histogram("block_seconds", "Duration of Timer blocks", block=name)
 
     def __enter__(self):
-        self.tstart = time.time()
+        self.tstart = time.monotonic()
 
     def __exit__(self, type, value, traceback):
-        duration = time.time() - self.tstart
+        duration = time.monotonic() - self.tstart
+        self.histogram.observe(duration)
         if duration > self.min_time:
             if duration > 2:
                 color = bcolors.FAIL
@@ -118,7 +104,270 @@ class Timer(object):
 
             print(f"{color}[{self.name}][{duration:.3f} seconds][{bcolors.ENDC}]")
 
+class Controller:
+    """
+    What the zones share: the UDP socket and its receive path, acknowledged
+    delivery, client health and discovery, the speaker and the RF remote.
+    Each datagram is routed to the zone of the device that sent it through
+    the ZoneRegistry, and every zone handles its events on its own EventLoop
+    thread, so a slow fade in one room never holds up another.
+    """
+    rx_buffer = 2048 # LD2410 lines are longer than the old 32 byte reads
+    rx_max_batch = 256 # datagrams per wakeup before yielding to timers
+    sound_policy = "preempt" # preempt, queue or mix, see SoundBank
+
+    def __init__(self, registry, mixer=None, state=None):
+        self.registry = registry
+        self.rx_stats = {"datagrams": 0, "batches": 0, "last_batch": 0, "max_batch": 0,
+                         "truncated": 0, "kernel_drops": 0}
+        self._rx_ancbuf = socket.CMSG_SPACE(4)
+        self.delivery = Delivery(sock, loop)
+        self.health = HealthMonitor(registry.ips(), port=UDP_PORT, on_change=self.client_state_changed)
+        self.discovery = ClientDiscovery(registry.macs(), on_change=self.set_client_ip)
+        self.determine_client_addresses()
+
+        self.sounds = SoundBank(self.sound_policy, latency_histogram=metrics.histogram(
+            "sound_latency_seconds", "Remote press to sound playback start"))
+        self.mixer = mixer if mixer is not None else make_mixer()
+        self.first_event_at = None
+
+        zone_states = (state or {}).get("zones", {})
+        self.zones = {name: LightClients(zone, self, zone_states.get(name))
+                      for name, zone in registry.zones.items()}
+        self.rf_zone = self.zones[registry.rf_zone().name]
+        # the speaker is played from the RF zone's loop
+        self.sounds.attach(self.rf_zone.loop, wait_histogram=metrics.histogram(
+            "device_queue_wait_seconds", "Command queued to sent, per device", device="audio"))
+
+        # UDP queries: name [args...] -> JSON reply. Zone queries take an
+        # optional zone name first and default to the RF zone
+        self.queries = {"HEALTH"   : self.health.stats,
+                        "DELIVERY" : self.delivery.stats,
+                        "RX"       : lambda: self.rx_stats,
+                        "STATS"    : metrics.collect,
+                        "ZONES"    : self.zone_stats,
+                        "LD2410"   : lambda *args: self.zone_query(LightClients.ld2410_stats, *args),
+                        "PRESENCE" : lambda *args: self.zone_query(lambda z: z.presence.stats(), *args),
+                        "RF"       : lambda *args: self.zone_query(lambda z: z.rf_decoder.stats, *args),
+                        "SCENES"   : lambda *args: self.zone_query(lambda z: z.scenes.stats(), *args),
+                        "AUTOMATIONS": lambda *args: self.zone_query(lambda z: z.automations.stats(), *args),
+                        "TIMERS"   : self.timer_stats,
+                        "QUEUES"   : self.queue_stats}
+
+    def start(self):
+        for lights in self.zones.values():
+            lights.start()
+
+    def load_audio(self):
+        # off the startup path: amixer can take up to its 2 s timeout
+        self.read_volume()
+        self.load_sounds()
+
+    def read_volume(self):
+        volume = self.mixer.get_volume()
+        if volume is not None:
+            for lights in self.zones.values():
+                lights.loop.call_soon_threadsafe(setattr, lights, "_volume", volume)
+
+    def load_sounds(self):
+        # delay announcements are optional, only the beeps are required
+        lights = self.rf_zone
+        self.sounds.load([lights.sound_up, lights.sound_down, lights.sound_bad_input] +
+                         [path for path in lights.delay_sounds if os.path.exists(path)])
+
+    def sync_devices(self):
+        for lights in self.zones.values():
+            lights.loop.call_soon_threadsafe(lights.sync_devices)
+
+    def probe_pwm_caps(self):
+        for lights in self.zones.values():
+            lights.loop.call_soon_threadsafe(lights.probe_pwm_caps)
+
+    def stale_zones(self, max_age):
+        now = time.monotonic()
+        return [name for name, lights in self.zones.items() if now - lights.alive_at > max_age]
+
+    def snapshot(self):
+        return {"zones": {name: lights.snapshot() for name, lights in self.zones.items()}}
+
+    def zone_query(self, query, *args):
+        lights = self.rf_zone
+        if args and args[0] in self.zones:
+            lights = self.zones[args[0]]
+            args = args[1:]
+        return query(lights, *args)
+
+    def zone_stats(self):
+        stats = self.registry.stats()
+        for name, lights in self.zones.items():
+            stats[name].update({"power_state": lights._power_state,
+                                "led": round(lights.led_fader.value, 1),
+                                "lamp": lights._lamp_brightness,
+                                "absent": lights.presence.absent,
+                                "loop_iterations": lights.loop.iterations})
+        return stats
+
+    def timer_stats(self):
+        stats = {"main": loop.timer_stats()}
+        for name, lights in self.zones.items():
+            stats[name] = lights.loop.timer_stats()
+        return stats
+
+    def queue_stats(self):
+        stats = {name: {kind: actor.stats() for kind, actor in lights.actors.items()}
+                 for name, lights in self.zones.items()}
+        stats["audio"] = self.sounds.stats()
+        return stats
+
+    def dispatch(self, event, device, addr, event_time):
+        # datagrams from unknown addresses (client_debug.py, TEST_MODE) go to the RF zone
+        if device is None:
+            lights, source = self.rf_zone, addr
+        else:
+            lights, source = self.zones[device.zone], device.name
+        lights.loop.call_soon_threadsafe(lights.handle_event, event, source, event_time)
+
+    def collect_metrics(self):
+        # read at export time from the counters the subsystems already keep
+        yield "loop_iterations_total", "counter", "EventLoop wakeups", {"loop": "main"}, loop.iterations
+        yield "loop_errors_total", "counter", "EventLoop callbacks that raised", {"loop": "main"}, loop.errors
+        for name, s in self.delivery.stats().items():
+            yield "sends_total", "counter", "Commands sent per device", {"device": name}, s["sent"]
+            yield "acks_total", "counter", "Commands acknowledged per device", {"device": name}, s["acked"]
+            yield "retries_total", "counter", "Command retransmissions per device", {"device": name}, s["retries"]
+            yield "send_failures_total", "counter", "Commands never acknowledged", {"device": name}, s["failed"]
+        for name, client in self.health.clients.items():
+            yield "client_up", "gauge", "1 if the client answers PING", {"client": name}, int(bool(client.up))
+        yield from queue_metrics(self.sounds.stats(), {"zone": self.rf_zone.name, "device": "audio"})
+        for key in ("datagrams", "batches", "truncated", "kernel_drops"):
+            yield f"rx_{key}_total", "counter", "UDP receive path", {}, self.rx_stats[key]
+        for name, s in COMMANDS.stats().items():
+            if s["count"] or s["rejected"]:
+                yield "commands_total", "counter", "Dispatched commands", {"command": name}, s["count"]
+                yield "commands_rejected_total", "counter", "Commands dropped by rate limits", {"command": name}, s["rejected"]
+        for lights in self.zones.values():
+            yield from lights.collect_metrics()
+
+    def receive_events(self, sock):
+        """
+        Drain every datagram that is queued on the socket, then ACK them all.
+        Returns (event, device, addr) to dispatch, in arrival order; device
+        is None for addresses that are not in the registry.
+        """
+        events = []
+        acks = []
+        stats = self.rx_stats
+        batch = 0
+        while batch < self.rx_max_batch:
+            try:
+                data, ancdata, flags, addr = sock.recvmsg(self.rx_buffer, self._rx_ancbuf)
+            except BlockingIOError:
+                break
+            batch += 1
+
+            for level, kind, value in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(value) >= 4:
+                    stats["kernel_drops"] = int.from_bytes(value[:4], sys.byteorder)
+            if flags & socket.MSG_TRUNC:
+                stats["truncated"] += 1
+
+            event = self.parse_datagram(data, addr, acks)
+            if event is not None:
+                events.append(event)
+
+        for addr in acks:
+            try:
+                sock.sendto(b"ACK", addr);
+            except OSError as e:
+                print(f"ACK to {addr[0]} failed: {e}", level=DEBUG)
+
+        stats["datagrams"] += batch
+        stats["batches"] += 1
+        stats["last_batch"] = batch
+        stats["max_batch"] = max(stats["max_batch"], batch)
+        return events
+
+    def parse_datagram(self, data, addr, acks):
+        event = data.decode('ascii', errors='replace').strip()
+
+        query = event.split()
+        if query and query[0] in self.queries:
+            # query from client_debug.py, answered with JSON instead of an ACK
+            try:
+                reply = json.dumps(self.queries[query[0]](*query[1:]))
+            except (TypeError, ValueError) as e:
+                reply = json.dumps({"error": str(e)})
+            except Exception as e:
+                # a broken query must not cost the rest of the batch
+                print(f"{query[0]} query failed: {e!r}", level=ERROR)
+                reply = json.dumps({"error": repr(e)})
+            try:
+                sock.sendto(reply.encode(), addr);
+            except OSError as e:
+                print(f"Reply to {addr[0]} failed: {e}", level=DEBUG)
+            return None
+
+        if event == "ACK" or event.startswith("ACK "):
+            self.delivery.handle_ack(addr[0], event)
+            return None
+
+        acks.append(addr)
+
+        global test_mode
+        if event == "TEST_MODE 0":
+            test_mode = False
+
+        if event == "TEST_MODE 1":
+            test_mode = True
+
+        addr=addr[0]
+        if test_mode and addr != MY_IP:
+            return None
+
+        device = self.registry.by_addr(addr)
+        if event.startswith("CAPS") and device is not None and device.kind == "pwm":
+            lights = self.zones[device.zone]
+            lights.loop.call_soon_threadsafe(lights.handle_caps, event)
+            return None
+
+        if "MOTION" in event:
+            source = addr if device is None else device.name
+            print(f"Got event : {bcolors.WARNING}{event}{bcolors.ENDC}".ljust(25) + f" from: {bcolors.WARNING}{source}{bcolors.ENDC}")
+
+        return event, device, addr
+
+    def determine_client_addresses(self):
+        # the kernel ARP table is instant; anything missing from it is
+        # resolved with a single arp-scan in the background
+        print("Finding Client IPs...")
+        self.discovery.resolve_all(scan=False)
+        if self.discovery.expired():
+            self.discovery.refresh_async("(missing from ARP table)")
+
+        for name, mac in self.registry.macs().items():
+            print(f"{name}[{mac}] : {self.registry.device(name).ip}")
+
+    def set_client_ip(self, name, ip):
+        old = self.registry.set_ip(name, ip)
+        if old != ip:
+            print(f"{name} changed {old} -> {ip}")
+            self.health.set_ip(name, ip)
+
+    def client_state_changed(self, name, up):
+        if not up and name in self.discovery.macs:
+            self.discovery.refresh_async(f"({name} stopped answering)")
+
+    def check_clients(self):
+        if self.discovery.expired():
+            self.discovery.refresh_async("(cache expired)")
+
+
 class LightClients:
+    """
+    One zone: its settings, power state, presence engine and fade engine.
+    Everything here runs on the zone's own EventLoop thread; other threads
+    post to it with self.loop.call_soon_threadsafe.
+    """
 
     delay_levels = [(30, "30s.mp3"),
                     (1*60, "1m.mp3"),
@@ -135,47 +384,194 @@ class LightClients:
     sound_down = os.path.join(dir_path,"sounds/down.wav")
     sound_bad_input = os.path.join(dir_path,"sounds/bad_input.wav")
     settings_path = os.path.join(dir_path,'settings.json')
-    LAMP_CLIENT_MAC = "E0:5A:1B:79:8D:88"
-    MOTION_CLIENT_MAC = "08:B6:1F:81:D8:C4"
-    LD2410_CLIENT_MAC = "08:B6:1F:81:6D:E0"
+    # (name, weight, hold seconds). Lights wake at a combined weight of 1, so
+    # the LD2410 alone can keep them on but cannot turn them back on
+    presence_sources = (("PIR", 1.0, 10), ("LD2410", 0.5, 5))
+    presence_source_kinds = {"motion": "PIR", "ld2410": "LD2410"}
+    led_fade_fps = 50
+    # brightness -> duty for the PWM output, unless its zones.json entry sets
+    # "response" (linear, gamma, cie) or "bits". Firmware that reports at
+    # least MIN_PERCEPTUAL_BITS in CAPS gets the cie response at its depth
+    pwm_response = "linear"
+    pwm_bits = 8
+    brightness_resolution = 10 # fade steps per percent
+    led_ramp_rate = 50 # percent per second while BRIGHTNESS_UP/DOWN is held
+    lamp_ramp_step = 5 # lamp percent per repeat while LAMP_UP/DOWN is held
     pi = None
 
-    def __init__(self):
-        """
-        self.SWITCH_CLIENT_IP = "192.168.50.140"
-        self.IR_CLIENT_IP = "192.168.50.140"
-        self.PWM_CLIENT_IP = "192.168.50.60"
-        self.MOTION_CLIENT_IP = "192.168.50.54"
-        self.LAMP_CLIENT_IP = "192.168.50.220"
-        self.LD2410_CLIENT_IP = "192.168.50.221"
-        """
-        self.load_ips()
-        #defaults
-        self._light_switch = "IR_LIGHT_OFF"
-        self._fan_switch = "IR_FAN_STOP"
-        self._brightness = 20
-        self._lamp_brightness = self._brightness
-        self._delay = 0
-        self._motion_enabled = True
-        self._volume = 70
-
-        if os.path.exists(self.settings_path):
-            self.load_settings()
+    def __init__(self, zone, controller, state=None):
+        self.zone = zone
+        self.name = zone.name
+        self.controller = controller
+        self.delivery = controller.delivery
+        self.sounds = controller.sounds
+        self.mixer = controller.mixer
+        self.loop = make_loop(self.name)
+        self.alive_at = time.monotonic()
+        # one queue per output device, latest intent per key wins
+        self.actors = {"pwm": self.make_actor("PWM", lambda item: self._deliver("pwm", *item)),
+                       "ir": self.make_actor("IR", lambda item: self._deliver("ir", *item)),
+                       "lamp": self.make_actor("LAMP", self._run_lamp)}
+        self.ld2410 = SensorRing()
+
+        self.delay_sounds = [os.path.join(dir_sounds, os.path.splitext(clip)[0] + ".wav")
+                             for _, clip in self.delay_levels]
+        self._event_time = None
+        self._event_source = None
+
+        # defaults live in settings.SCHEMA
+        self.settings = SettingsStore(self.zone_settings_path())
+        self.load_settings()
 
         self._power_state = True
-        self._motion_timer = time.time() + 10 #add 10 seconds so no timeout will happen on reboots or power outages
-        self.remote_delay = 0.25
-        self.last_remote_time = 0
+        self.presence = PresenceEngine(self.loop, [Source(*source) for source in self.presence_sources],
+                                       interval=lambda: self.delay_levels[self._delay][0],
+                                       on_present=self.motion_on, on_absent=self.motion_timeout)
+        self.presence.touch(time.monotonic() + 10) #add 10 seconds so no timeout will happen on reboots or power outages
+        self.rf_decoder = RFDecoder(self.loop, policy_for=lambda name: COMMANDS.get(name).repeat,
+                                    on_gesture=self.handle_rf_gesture)
         self.last_pwm_brightness_set = self._brightness
         self.off_because_of_motion = False
+        self.pwm_fade_supported = False
+        self.pwm_curves = set() # fade curves the PWM firmware runs itself, from CAPS
+        self.pwm_caps_bits = None # duty bits the PWM firmware reports in CAPS
+        self._caps_pending = False
+        self._resume_led = None
+        if state is not None:
+            try:
+                self.restore(state)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Ignoring state snapshot for zone {self.name}: {e}", level=WARNING)
+
+        self.pwm_table = self.make_duty_table()
+        self._last_duty = None
+        self.led_fader = Fader(self.device_label("LED"), self._setPWMBrightness,
+                               value=self.last_pwm_brightness_set, fps=self.led_fade_fps,
+                               resolution=self.brightness_resolution)
+        self.scenes = SceneEngine(self.loop, {"led": self._scene_led, "lamp": self._scene_lamp,
+                                              "light": self._scene_ir, "fan": self._scene_ir},
+                                  histogram=metrics.histogram("scene_converge_seconds",
+                                                              "Scene start to every device at its target",
+                                                              zone=self.name))
+        self.automations = AutomationScheduler(self.loop, [a for a in AUTOMATIONS if a.applies_to(self.name)],
+                                               self.run_automation)
+
+    def start(self):
+        self.automations.start()
+        self.loop.call_every(HEARTBEAT_INTERVAL, self._tick)
+        threading.Thread(target=self._run_loop, name=f"zone-{self.name}", daemon=True).start()
+
+    def _tick(self):
+        # proof for the heartbeat that this loop still turns
+        self.alive_at = time.monotonic()
+
+    def _run_loop(self):
+        try:
+            self.loop.run()
+        except BaseException:
+            # callbacks are guarded, so this is fatal: exit through the main
+            # loop (and onClose) and let supervisor.py start a fresh worker
+            print(f"Zone {self.name} event loop died, exiting", level=ERROR)
+            _thread.interrupt_main()
+            raise
+
+    def zone_settings_path(self):
+        # the RF zone keeps settings.json, other zones get settings.<zone>.json
+        if self.zone.settings:
+            return os.path.join(dir_path, self.zone.settings)
+        if self.zone.rf:
+            return self.settings_path
+        root, ext = os.path.splitext(self.settings_path)
+        return f"{root}.{self.name}{ext}"
+
+    def make_duty_table(self):
+        bits = self.pwm_caps_bits or self.pwm_bits
+        response = "cie" if bits >= MIN_PERCEPTUAL_BITS else self.pwm_response
+        device = self.zone.device("pwm")
+        options = device.options if device is not None else {}
+        try:
+            return DutyTable(options.get("response", response), options.get("bits", bits),
+                             self.brightness_resolution)
+        except (TypeError, ValueError) as e:
+            print(f"Bad PWM options for zone {self.name} ({e}), using {response} {bits} bit", level=WARNING)
+            return DutyTable(response, bits, self.brightness_resolution)
+
+    def make_actor(self, name, handle):
+        label = self.device_label(name)
+        return DeviceActor(label, self.loop, handle, discard=self._discard_intent,
+                           wait_histogram=metrics.histogram("device_queue_wait_seconds",
+                                                            "Command queued to sent, per device", device=label))
+
+    @staticmethod
+    def _discard_intent(item):
+        # (..., on_ack) for every device: a replaced intent never completes
+        on_ack = item[-1]
+        if on_ack is not None:
+            on_ack(False)
+
+    def device_label(self, name):
+        return name if self.zone.rf else f"{self.name}/{name}"
+
+    def snapshot(self):
+        # runtime state that is not in settings.json, handed to the next
+        # worker by supervisor.py
+        return {"time": time.time(),
+                "power_state": self._power_state,
+                "off_because_of_motion": self.off_because_of_motion,
+                "pwm_fade_supported": self.pwm_fade_supported,
+                "pwm_curves": sorted(self.pwm_curves),
+                "pwm_bits": self.pwm_caps_bits,
+                "led": {"value": round(self.led_fader.value, 2),
+                        "target": self.led_fader.target,
+                        "remaining": round(self.led_fader.remaining, 3)},
+                "presence": {"absent": self.presence.absent,
+                             "remaining": round(self.presence.deadline() - time.monotonic(), 3)}}
+
+    def restore(self, state):
+        elapsed = max(0, time.time() - state["time"])
+        self._power_state = state["power_state"]
+        self.off_because_of_motion = state["off_because_of_motion"]
+        self.pwm_fade_supported = state["pwm_fade_supported"]
+        self.pwm_curves = set(state.get("pwm_curves", ()))
+        self.pwm_caps_bits = state.get("pwm_bits")
+
+        # move an in-flight fade on by the time the restart took
+        led = state["led"]
+        value, target, remaining = led["value"], led["target"], led["remaining"]
+        if remaining > elapsed:
+            value += (target - value) * elapsed / remaining
+            remaining -= elapsed
+        else:
+            value, remaining = target, 0
+        self.last_pwm_brightness_set = value
+        self._resume_led = (value, target, remaining)
+
+        interval = self.delay_levels[self._delay][0]
+        self.presence.touch(time.monotonic() + state["presence"]["remaining"] - elapsed - interval)
+        self.presence.absent = state["presence"]["absent"]
+        print(f"Resumed from snapshot {elapsed * 1000:.0f} ms old: power {self._power_state}, LED {value:.0f} -> {target}")
+
+    def sync_devices(self):
+        if self._resume_led is not None:
+            # resumed from a supervisor snapshot: the clients already have this
+            # state, only carry on with a fade that was still running
+            value, target, remaining = self._resume_led
+            self._resume_led = None
+            if remaining > 0:
+                on_frame = self._trackPWMBrightness if self.offload_fade("linear") else None
+                self.led_fader.fade_to(target, remaining, on_frame=on_frame)
+            self.probe_pwm_caps()
+            return
 
+        # push the saved state to every client; all non-blocking sends
         if self._power_state:
             self._setPWMBrightness(self._brightness)
             self.fade_lamp(1,self._lamp_brightness)
 
-        sock.sendto(self._light_switch.encode(), (self.IR_CLIENT_IP, UDP_PORT));
-        sock.sendto(self._fan_switch.encode(), (self.IR_CLIENT_IP, UDP_PORT));
+        self.probe_pwm_caps()
 
+        self.send_ir(self._light_switch)
+        self.send_ir(self._fan_switch)
 
     def increase_volume(self):
         volume = self._volume
@@ -186,7 +582,7 @@ class LightClients:
         if volume > 100:
             return False
 
-        subprocess.run(["amixer", "sset","'Speaker'", str(volume) + '%'])
+        self.mixer.set_volume(volume)
         self._volume = volume
         print("volume = " + str(self._volume))
         return True
@@ -195,198 +591,223 @@ class LightClients:
         volume = self._volume
         volume -= 5
         if volume < 60:
-            subprocess.run(["amixer", "sset","'Speaker'", '0%'])
+            self.mixer.set_volume(0)
             return False
 
-        subprocess.run(["amixer", "sset","'Speaker'", str(volume) + '%'])
+        self.mixer.set_volume(volume)
         self._volume = volume
         print("volume = " + str(self._volume))
         return True
 
     def handle_remote_event(self, event):
-        if time.time() - self.last_remote_time < self.remote_delay:
+        self.run_command(COMMANDS.get(event), event)
+
+    def run_command(self, command, event, check_rate=True):
+        if check_rate and not COMMANDS.allow(command, scope=self.name):
             print(f"Ignoring input {event} happened too soon after last remote event")
             return
 
-        self.last_remote_time = time.time()
+        if command.kind == "remote":
+            # somebody is using the remote, restart the auto dim countdown
+            self.presence.touch()
 
-        if event == "POWER_BUTTON":
-            if self._power_state:
-                print("TURNING OFF")
-                if led_lock.locked() or lamp_lock.locked():
-                    return None
+        sound = command.sound(self) if command.sound_first and command.sound is not None else None
+        event = COMMANDS.dispatch(command, self, event)
+        if event is None:
+            return
 
-                self._power_state = False
-                self.fade_leds(1, 0, on_off_event=True)
-                self.fade_lamp(1, 0, on_off_event=True)
-            else:
-                print("TURNING ON")
-                if led_lock.locked() or lamp_lock.locked():
-                    return None
-                self._power_state = True
-                self.fade_leds(1, self._brightness, on_off_event=True)
-                self.fade_lamp(1, self._lamp_brightness, on_off_event=True)
-        elif event == "LIGHT_SWITCH":
-            if self._light_switch == "IR_LIGHT_ON":
-               self._light_switch = "IR_LIGHT_OFF"
-            else:
-                self._light_switch = "IR_LIGHT_ON"
+        if command.sound is not None:
+            self.alert(event, sound if event == command.name else None)
+        if command.persist:
+            self.save_settings()
 
-            sock.sendto(self._light_switch.encode(), (self.IR_CLIENT_IP, UDP_PORT));
+    def cmd_power_button(self, event):
+        if self._power_state:
+            print("TURNING OFF")
+            self.apply_scene("OFF")
+        else:
+            print("TURNING ON")
+            self.apply_scene("ON")
+        return event
 
-        elif event == "FAN_SWITCH":
-            if self._fan_switch == "IR_FAN_LOW":
-                self._fan_switch = "IR_FAN_MID"
-            elif self._fan_switch == "IR_FAN_MID":
-                self._fan_switch = "IR_FAN_HIGH"
-            elif self._fan_switch == "IR_FAN_HIGH":
-                self._fan_switch = "IR_FAN_STOP"
-            elif self._fan_switch == "IR_FAN_STOP":
-                self._fan_switch = "IR_FAN_LOW"
+    def cmd_scene(self, event):
+        self.apply_scene(event)
+        return event
 
-            sock.sendto(self._fan_switch.encode(), (self.IR_CLIENT_IP, UDP_PORT));
+    def run_automation(self, automation):
+        if automation.only_if_on and not self._power_state:
+            return False
+        self.apply_scene(automation.scene)
+        # presets replace the saved levels, as cmd_scene persists them
+        self.save_settings()
+        return True
 
-        elif event == "STOP_BUTTON":
-            if self._motion_enabled:
-                self.disable_motion()
-            else:
-                self.enable_motion()
+    def cmd_light_switch(self, event):
+        if self._light_switch == "IR_LIGHT_ON":
+           self._light_switch = "IR_LIGHT_OFF"
+        else:
+            self._light_switch = "IR_LIGHT_ON"
 
-        elif event == "BRIGHTNESS_UP":
-            if not self._power_state:
-                self._power_state = True
+        self.send_ir(self._light_switch)
+        return event
 
-            level = min(100, round5(self._brightness + 10))
-
-            if not self.fade_leds(0, level):
-                return None
-
-        elif event == "BRIGHTNESS_DOWN":
-            level = max(0, self._brightness - 10)
-
-            if not self.fade_leds(0, level):
-                return None
-
-        elif event == "BRIGHTNESS_MIN":
-            if not self.fade_leds(1, 1):
-                return None
-            if not self.fade_lamp(1, 5):
-                return None
-        elif event == "BRIGHTNESS_75":
-            if not self.fade_leds(1, 60):
-                return None
-            if not self.fade_lamp(1, 60):
-                return None
-        elif event == "DELAY_30S":
-            self._delay = 0
-        elif event  == "DELAY_10M":
-            self._delay = 4
-        elif event  == "DELAY_1H":
-            self._delay = 6
-        elif event  == "DELAY_3H":
-            self._delay = 8
-        elif event  == "LAMP_UP":
-            if not self._power_state:
-                self._power_state = True
+    fan_cycle = {"IR_FAN_LOW"  : "IR_FAN_MID",
+                 "IR_FAN_MID"  : "IR_FAN_HIGH",
+                 "IR_FAN_HIGH" : "IR_FAN_STOP",
+                 "IR_FAN_STOP" : "IR_FAN_LOW"}
 
-            if lamp_lock.locked():
-                return None
-            if self._lamp_brightness <= 80:
-                if not self.fade_lamp(0, self._lamp_brightness + 10):
-                    return None
-        elif event  == "LAMP_DOWN":
-            if lamp_lock.locked():
-                return None
-            if self._lamp_brightness >= 0:
-                self.fade_lamp(0, self._lamp_brightness - 10)
-            else:
-                event = "BAD_INPUT"
-        elif event == "VOLUME_UP":
-            if not self.increase_volume():
-                event = "BAD_INPUT"
-        elif event == "VOLUME_DOWN":
-            if not self.decrease_volume():
-                event = "BAD_INPUT"
-
-        elif event[:3] == "IR_":
-            sock.sendto(event.encode(), (self.IR_CLIENT_IP, UDP_PORT));
-
-        self.alert(event)
-        self.save_settings()
-        time.sleep(0.05)
+    def cmd_fan_switch(self, event):
+        self._fan_switch = self.fan_cycle.get(self._fan_switch, "IR_FAN_STOP")
+        self.send_ir(self._fan_switch)
+        return event
 
-    def handle_motion_event(self, event):
+    def cmd_stop_button(self, event):
+        if self._motion_enabled:
+            self.disable_motion()
+        else:
+            self.enable_motion()
+        return event
 
-        if not self._motion_enabled:
-            if event == "MOTION_DETECTED":
-                self._motion_timer = time.time()
-            motionless_time = time.time() - self._motion_timer
-            return
+    def cmd_brightness_up(self, event):
+        if not self._power_state:
+            self._power_state = True
 
-        if event == "MOTION_DETECTED":
-            self._motion_timer = time.time()
-            if not self._power_state:
-                print("Motion detected when lights are off!")
-                print(f"Turning lights on quickly! LED level = {self._brightness}, Lamp level = {self._lamp_brightness}")
-                self.off_because_of_motion = False
-                self.fade_leds(1, self._brightness, on_off_event=True)
-                self.fade_lamp(1, self._lamp_brightness, on_off_event=True)
+        level = min(100, round5(self._brightness + 10))
+
+        if not self.fade_leds(0, level):
+            return None
+        return event
+
+    def cmd_brightness_down(self, event):
+        level = max(0, self._brightness - 10)
+
+        if not self.fade_leds(0, level):
+            return None
+        return event
+
+    delay_presets = {"DELAY_30S": 0, "DELAY_10M": 4, "DELAY_1H": 6, "DELAY_3H": 8}
+
+    def cmd_delay(self, event):
+        self._delay = self.delay_presets[event]
+        self.presence.rearm()
+        return event
+
+    def cmd_lamp_up(self, event):
+        if not self._power_state:
+            self._power_state = True
+
+        if self._lamp_brightness <= 80:
+            self.fade_lamp(0, self._lamp_brightness + 10)
+        return event
+
+    def cmd_lamp_down(self, event):
+        if self._lamp_brightness >= 0:
+            self.fade_lamp(0, self._lamp_brightness - 10)
+        else:
+            return "BAD_INPUT"
+        return event
+
+    def hold_brightness(self, event, phase):
+        # one fade to the end of the range, cut short where the button is let go
+        if phase == "hold":
+            # like a single press, only brightening turns the lights on
+            if event == "BRIGHTNESS_UP":
                 self._power_state = True
+            target = 100 if event == "BRIGHTNESS_UP" else 0
+            self.fade_leds(abs(target - self.led_fader.value) / self.led_ramp_rate, target)
+        elif phase == "release":
+            self.fade_leds(0, round(self.led_fader.value))
+            self.save_settings()
+
+    def hold_lamp(self, event, phase):
+        # LAMPSET takes whole seconds, so the lamp ramps in small instant steps
+        step = self.lamp_ramp_step if event == "LAMP_UP" else -self.lamp_ramp_step
+        level = max(0, min(100, self._lamp_brightness + step))
+        if level != self._lamp_brightness and self.fade_lamp(0, level):
+            self.save_settings()
+
+    def cmd_volume_up(self, event):
+        if not self.increase_volume():
+            return "BAD_INPUT"
+        return event
+
+    def cmd_volume_down(self, event):
+        if not self.decrease_volume():
+            return "BAD_INPUT"
+        return event
+
+    def cmd_ir(self, event):
+        self.send_ir(event)
+        return event
+
+    def cmd_none(self, event):
+        return event
+
+    def cmd_motion(self, event):
+        self.handle_motion_event(event)
+        return event
+
+    def handle_motion_event(self, event):
+        device = self.controller.registry.device(self._event_source)
+        source = self.presence_source_kinds.get(device.kind if device else None, "PIR")
+        if event == "MOTION_DETECTED":
+            self.presence.detection(source, self._event_time)
+        else:
+            self.presence.clear(source)
+
+    def motion_on(self):
+        if not self._motion_enabled or self._power_state:
+            return False
+
+        print("Motion detected when lights are off!")
+        print(f"Turning lights on quickly! LED level = {self._brightness}, Lamp level = {self._lamp_brightness}")
+        self.off_because_of_motion = False
+        self.apply_scene("ON")
+        return True
+
+    def motion_timeout(self):
+        if not self._motion_enabled or not self._power_state:
+            return False
 
         interval = self.delay_levels[self._delay][0]
-        motionless_time = time.time() - self._motion_timer
-        if motionless_time > 1:
-            print(f"interval: {interval}, motionless_time: {motionless_time}")
-
-        if motionless_time > interval:
-            if self._power_state:
-                print(f"Motion not detected for {interval} seconds")
-                print("TURNING LIGHT to 1% AUTOMATICALLY OVER 3 Seconds")
-                self.off_because_of_motion = True
-                self.fade_leds(3,1, on_off_event=True)
-                self.fade_lamp(3,1, on_off_event=True)
-                self._power_state = False
-
-    def handle_event(self, event):
+        print(f"Motion not detected for {interval} seconds")
+        print("TURNING LIGHT to 1% AUTOMATICALLY OVER 3 Seconds")
+        self.off_because_of_motion = True
+        self.apply_scene("MOTION_OFF")
+        return True
+
+    def handle_rf_gesture(self, name, phase, event_time):
+        if phase == "press":
+            self.handle_event(name, "RF", event_time)
+            return
+
+        command = COMMANDS.get(name)
+        self._event_time = event_time
+        self.presence.touch()
+        print(f"Remote {name} {phase}")
+        if command.hold is not None:
+            command.hold(self, name, phase)
+        elif phase == "repeat":
+            self.run_command(command, name, check_rate=False)
+
+    def handle_event(self, event, source=None, event_time=None):
         if event is None:
             return
 
         event = event.strip()
-
-        remote_events = (
-                            "POWER_BUTTON",
-                            "STOP_BUTTON",
-                            "BRIGHTNESS_UP",
-                            "LAMP_UP",
-                            "BRIGHTNESS_75",
-                            "BRIGHTNESS_DOWN",
-                            "LAMP_DOWN",
-                            "BRIGHTNESS_MIN",
-                            "VOLUME_UP",
-                            "DELAY_30S",
-                            "VOLUME_DOWN",
-                            "DELAY_1H",
-                            "DELAY_3H",
-                            "DELAY_10M",
-                            "IR_FAN_STOP",
-                            "IR_LIGHT_ON",
-                            "IR_LIGHT_OFF",
-                            "IR_FAN_LOW",
-                            "IR_FAN_MID",
-                            "IR_FAN_HIGH",
-                            "MUSIC_BUTTON",
-                            "LIGHT_SWITCH",
-                            "FAN_SWITCH",
-                         )
-
-        motion_events = ("MOTION_DETECTED", "MOTIONLESS")
-
-        if event in remote_events:
-            print(f"Got remote event: {event}")
-            self.handle_remote_event(event)
-        elif event in motion_events:
-            print(f"Got motion event: {event}")
-            self.handle_motion_event(event)
+        self._event_time = time.monotonic() if event_time is None else event_time
+        self._event_source = source
+        if self.controller.first_event_at is None:
+            self.controller.first_event_at = self._event_time
+            startup = self._event_time - started_at
+            metrics.gauge("first_event_seconds", "Startup to first handled event").set(round(startup, 3))
+            print(f"First event {event} handled {startup * 1000:.0f} ms after startup")
+
+        command = COMMANDS.get(event)
+        if command is not None:
+            print(f"Got {command.kind} event: {event}")
+            # repeats of a held RF button are already folded by the RFDecoder
+            self.run_command(command, event, check_rate=source != "RF")
         else:
             if not self.parse_ld2410_info(event) and event != "ACK":
                 print(f"Got unknown event {event}")
@@ -398,7 +819,7 @@ class LightClients:
             return True
 
         if "Stationary" in event or "Moving" in event:
-            print(event)
+            self.ld2410.add_line(event)
             return True
         if "Detected" in event:
             return
@@ -406,6 +827,9 @@ class LightClients:
         return False
 
 
+    def ld2410_stats(self, window=60, resolution=1):
+        return self.ld2410.stats(float(window), float(resolution))
+
     def set_brightness(self, level):
         if level > 100:
             level = 100
@@ -414,80 +838,142 @@ class LightClients:
 
         self._brightness = level
         self._setPWMBrightness(level)
-        print(f"Brightness set to {level}")
+        print(f"Brightness set to {level}", level=DEBUG)
 
-    def _setPWMBrightness(self, brightness):
-        level = int(brightness * 2.55)
-        if brightness == 100:
-            level = 255
-        if brightness == 0:
-            level = 0
-        if brightness == 1:
-            level = 2
+    def _pwm_duty(self, brightness):
+        return self.pwm_table.duty(brightness)
 
-        cmd = f"^SET_PWM {level}$"
-        print(cmd)
-        sock.sendto(cmd.encode(), (self.PWM_CLIENT_IP, UDP_PORT));
+    def _setPWMBrightness(self, brightness):
         self.last_pwm_brightness_set = brightness
+        # fade steps finer than the output's duty resolution send nothing
+        duty = self._pwm_duty(brightness)
+        if duty == self._last_duty:
+            return
+        self._last_duty = duty
+        cmd = f"^SET_PWM {duty}$"
+        print(cmd, level=DEBUG)
+        self.send_pwm(cmd)
 
-    def _fade_lamp_thread(self, ftime):
-        with lamp_lock:
-            time.sleep(ftime+0.1)
-        print("Done processing lamp brightness request")
-
-
-    def fade_lamp(self, ftime, value, on_off_event=False):
-        if lamp_lock.locked() and not on_off_event:
-            print("Lamp currently processing last request. Returning")
-            return False
-
-        while lamp_lock.locked() and on_off_event:
-            print("Waiting for last event to end for critical on_off_event request to lamp")
-            time.sleep(0.05)
+    def _trackPWMBrightness(self, brightness):
+        # the PWM client runs the fade itself, only follow its timeline
+        self.last_pwm_brightness_set = brightness
 
-        self.send_to_lamp(int(ftime), int(value))
-        print(f"Sent fade request to lamp. Duty = {value}, time = {ftime}")
+    def _sendPWMFade(self, start, end, ftime, curve="linear"):
+        cmd = f"^FADE {self._pwm_duty(start)} {self._pwm_duty(end)} {int(ftime * 1000)} {curve}$"
+        print(cmd)
+        self._last_duty = None # the client moves the duty on its own now
+        self.send_pwm(cmd)
+
+    def offload_fade(self, curve):
+        # the firmware interpolates duty, which is only the fade we want when
+        # duty is linear in brightness
+        return (self.pwm_fade_supported and self.pwm_table.response == "linear"
+                and (curve == "linear" or curve in self.pwm_curves))
+
+    def probe_pwm_caps(self):
+        # firmware that understands FADE answers "CAPS FADE ...", old firmware ignores it
+        if self._caps_pending and self.pwm_fade_supported:
+            print("PWM client stopped answering CAPS, falling back to SET_PWM steps")
+            self.pwm_fade_supported = False
+        self._caps_pending = True
+        self.send_pwm("^CAPS$", key="caps")
+
+    def handle_caps(self, caps):
+        # "CAPS FADE BITS=12 linear ease ...", BITS missing on 8 bit firmware
+        self._caps_pending = False
+        words = caps.split()[1:]
+        supported = "FADE" in words
+        if supported != self.pwm_fade_supported:
+            print(f"PWM client FADE support: {supported}")
+        self.pwm_fade_supported = supported
+        bits = [w for w in words if w.startswith("BITS=")]
+        self.pwm_curves = set(words) - {"FADE"} - set(bits)
+        try:
+            bits = int(bits[0][5:]) if bits else None
+        except ValueError:
+            print(f"Ignoring bad bit depth in {caps}", level=WARNING)
+            bits = self.pwm_caps_bits
+        if bits != self.pwm_caps_bits:
+            self.pwm_caps_bits = bits
+            self.pwm_table = self.make_duty_table()
+            print(f"PWM client reports {bits} bit duty, using {self.pwm_table.response} {self.pwm_table.bits} bit")
+            if not self.led_fader.active:
+                # the same level is a different duty in the new table
+                self._last_duty = None
+                self._setPWMBrightness(self.last_pwm_brightness_set)
+
+    def fade_lamp(self, ftime, value, on_off_event=False, on_ack=None, end=None):
+        # the lamp ignores requests during its fade: this one waits for it
+        # to finish, and replaces any request still waiting
         if not on_off_event:
             self._lamp_brightness = int(value)
-        threading.Thread(target=self._fade_lamp_thread, args=(ftime,)).start()
+        self.actors["lamp"].submit("lamp", (int(value), ftime, end, on_ack))
         return True
 
-    def _fade_leds_thread(self, ftime, value, on_off_event=False):
-        start_value = self.last_pwm_brightness_set
-
-        with led_lock:
-            if start_value > value:
-                r = range(start_value, value - 1, -1)
-            else:
-                r = range(start_value, value + 1)
-
-            t = ftime/len(r)
-
-            for i in r:
-                if lock_fade_request.locked():
-                    return
-                if on_off_event: #dont set brightness setting when turning on or off
-                    self._setPWMBrightness(i)
-                else:
-                    self.set_brightness(i)
-                time.sleep(t)
-
-
-    def fade_leds(self, ftime, value, on_off_event=False):
-        if led_lock.locked() and on_off_event:
-            with lock_fade_request:
-                while led_lock.locked():
-                    time.sleep(.01)
-                    print("Waiting for old fade to end early")
+    def _run_lamp(self, item):
+        level, ftime, end, on_ack = item
+        if end is not None:
+            # LAMPSET takes whole seconds; aim for the scene's end time
+            ftime = max(0, round(end - time.monotonic()))
+        self.send_to_lamp(ftime, level, on_ack)
+        print(f"Sent fade request to lamp. Duty = {level}, time = {ftime}")
+        return int(ftime) + 0.1
+
+    def fade_leds(self, ftime, value, on_off_event=False, on_done=None, start_at=None, curve="linear"):
+        value = max(0, min(100, value))
+        if not on_off_event: #dont set brightness setting when turning on or off
+            self._brightness = value
+
+        # retargets any fade in flight, starting from the level it has reached.
+        # Clients that can run this fade get one packet and we only track the
+        # timeline; otherwise the fader steps through the duty table
+        if self.offload_fade(curve):
+            start = self.led_fader.fade_to(value, ftime, on_done=on_done, on_frame=self._trackPWMBrightness,
+                                           start_at=start_at, curve=curve)
+            self._sendPWMFade(start, value, ftime, curve)
+        else:
+            start = self.led_fader.fade_to(value, ftime, on_done=on_done, start_at=start_at, curve=curve)
+        print(f"Started LED fade {start:.0f} -> {value} over {ftime}s")
+        return True
 
-        if led_lock.locked():
-            print("Led fade is locked")
-            return False
+    def apply_scene(self, name):
+        scene = SCENES.get(name)
+        if scene.power is not None:
+            self._power_state = scene.power
+        if not scene.on_off:
+            # presets become the saved levels, power on/off only restores them
+            for device, target in scene.batch:
+                if device == "led" and target != SAVED:
+                    self._brightness = target
+                elif device == "lamp" and target != SAVED:
+                    self._lamp_brightness = target
+        print(f"Applying scene {name}")
+        return self.scenes.apply(scene)
+
+    def _scene_led(self, target, scene, start, done):
+        level = self._brightness if target == SAVED else target
+        self.fade_leds(scene.duration, level, on_off_event=True,
+                       on_done=lambda achieved: done(None if achieved is None else True),
+                       start_at=start, curve=scene.curve)
+
+    def _scene_lamp(self, target, scene, start, done):
+        level = self._lamp_brightness if target == SAVED else target
+        end = start + scene.duration
+        self.fade_lamp(scene.duration, level, on_off_event=True, end=end,
+                       on_ack=lambda acked: self.loop.call_soon_threadsafe(self._lamp_acked, acked, end, done))
+
+    def _lamp_acked(self, acked, end, done):
+        if acked is False:
+            done(False)
+        else:
+            self.loop.call_later(max(0, end - time.monotonic()), done, True)
 
-        self._fade_thread = threading.Thread(target=self._fade_leds_thread,
-                                            args=(ftime, value, on_off_event)).start()
-        print("Started fade request thread")
-        return True
+    def _scene_ir(self, target, scene, start, done):
+        if target.startswith("IR_LIGHT"):
+            self._light_switch = target
+        elif target.startswith("IR_FAN"):
+            self._fan_switch = target
+        self.send_ir(target, on_ack=lambda acked: done(acked is not False))
 
     def delay_increase(self):
         self._delay += 1
@@ -497,203 +983,215 @@ class LightClients:
 
     def set_delay_level(self, level):
         self._delay = level
+        self.presence.rearm()
 
     def enable_motion(self):
         self._motion_enabled = True
+        self.presence.touch()
 
     def disable_motion(self):
         self._motion_enabled = False
 
-    def load_ips(self):
-        for name, ip in CLIENT_IPS.items():
-            if type(ip) == type(""):
-                exec(f'self.{name} = "{ip}"')
-            else:
-                exec(f'self.{name} = {ip}')
-
     def load_settings(self):
-        print("Loading saved settings")
-        if os.path.exists(self.settings_path):
-            with open(self.settings_path, 'r') as f:
-                saved_settings = json.load(f)
-
-
-        for key, value in saved_settings.items():
-            if type(value) == type(""):
-                exec(f'{key} = "{value}"')
+        s = self.settings.values
+        self._brightness = s["brightness"]
+        self._lamp_brightness = s["lamp_brightness"]
+        self._delay = s["delay"]
+        self._motion_enabled = s["motion_enabled"]
+        self._volume = s["volume"]
+        self._light_switch = s["light_switch"]
+        self._fan_switch = s["fan_switch"]
+
+    def alert(self, event, sound=None):
+        # sound is given when it was picked before the command ran
+        if sound is None:
+            command = COMMANDS.get(event)
+            if command is None or command.sound is None:
+                # BAD_INPUT and anything without a feedback sound of its own
+                sound = self.sound_bad_input
             else:
-                exec(f'{key} = {value}')
+                sound = command.sound(self)
 
-            print(f'Loaded {key} = {value}')
+        self.sounds.play(sound, self._event_time)
 
-    def play_thread(self, sound):
-        with play_lock:
-            subprocess.run(['aplay', sound])
-
-    def alert(self, event):
-        sound = self.sound_bad_input
-
-        if event == "MOTION_DETECTED" or event == "MOTIONLESS":
-            print("No sound for this event")
-            return
-
-        elif event == "POWER_BUTTON":
-            if self._power_state:
-                sound = self.sound_up
-            else:
-                sound = self.sound_down
-        elif event == "STOP_BUTTON":
-            if self._motion_enabled:
-                sound = self.sound_up
-            else:
-                sound = self.sound_down
-        elif event in ("VOLUME_UP", "BRIGHTNESS_UP"):
-            sound = self.sound_up
-        elif event in ("VOLUME_DOWN", "BRIGHTNESS_DOWN"):
-            sound = self.sound_down
-        elif "DELAY" in event:
-            sound = self.sound_up
-        elif event == "BRIGHTNESS_75":
-            if  self._brightness == 75:
-                sound = self.sound_bad_input
-            elif self._brightness > 75:
-                sound = self.sound_down
-            elif self._brightness < 75:
-                sound = self.sound_up
-        elif event == "BRIGHTNESS_MIN":
-            if (self._brightness == 1):
-                sound = self.sound_bad_input
-            else:
-                sound = self.sound_up
-        elif event == "BRIGHTNESS_100":
-            if self._brightness == 100:
-                sound = self.sound_bad_input
-            elif self._brightness > 100:
-                sound = self.sound_down
-            elif self._brightness < 100:
-                sound = self.sound_up
-        elif "LAMP_UP" == event:
-            if self._lamp_brightness > 75:
-                sound = self.sound_bad_input
-            else:
-                sound = self.sound_up
-        elif "LAMP_DOWN" == event:
-            if self._lamp_brightness <= 0:
-                sound = self.sound_bad_input
-            else:
-                sound = self.sound_down
-        elif event == "IR_FAN_STOP":
-            sound = self.sound_down
-        elif event == "IR_LIGHT_OFF":
-            sound = self.sound_down
-        elif event[:3] == "IR_":
+    def sound_delay(self):
+        sound = self.delay_sounds[self._delay]
+        if sound not in self.sounds:
             sound = self.sound_up
+        return sound
 
-        if play_lock.locked():
-            return
-
-        threading.Thread(target=self.play_thread, args=(sound,), daemon=True).start()
+    def sound_level(self, level, target, bad_if=None):
+        if level == bad_if:
+            return self.sound_bad_input
+        return self.sound_down if level > target else self.sound_up
 
 
     def save_settings(self):
-        with Timer("Save Settings Thread"):
-            s = defaultdict(int)
-
-            s['self._brightness'] = self._brightness
-            s['self._lamp_brightness'] = self._lamp_brightness
-            s['self._delay'] = self._delay
-            s['self._motion_enabled'] = self._motion_enabled
-            s['self._volume'] = self._volume
-            s['self._light_switch'] = self._light_switch
-            s['self._fan_switch'] = self._fan_switch
-
-
-            with open(self.settings_path, 'w') as f:
-                json.dump(s, f)
-            print(json.dumps(s, indent=4))
-
-    def get_data(self, sock):
-        try:
-            data, addr = sock.recvfrom(32)
-            client_name = addr
-            event = data.decode('ascii').strip()
-            sock.sendto("ACK".encode(), addr);
-
-            global test_mode
-            if event == "TEST_MODE 0":
-                test_mode = False
-
-            if event == "TEST_MODE 1":
-                test_mode = True
-
-            addr=addr[0]
-            if test_mode and addr != "192.168.50.39":
-                return None
-
-
-            if addr == self.MOTION_CLIENT_IP:
-                addr = "MOTION CLIENT"
-            elif addr == self.LAMP_CLIENT_IP:
-                addr = "LAMP CLIENT"
-            elif addr == self.LD2410_CLIENT_IP:
-                addr = "LD2410_CLIENT"
-            elif addr == self.IR_CLIENT_IP:
-                addr = "IR_CLIENT"
-            elif addr == self.SWITCH_CLIENT_IP:
-                addr = "SWITCH_CLIENT"
-
-            if "MOTION" in event:
-                print(f"Got event : {bcolors.WARNING}{event}{bcolors.ENDC}".ljust(25) + f" from: {bcolors.WARNING}{addr}{bcolors.ENDC}")
-
-            if event == "MOTION_DETECTED" and self._motion_enabled and self.off_because_of_motion and addr == "LD2410_CLIENT":
-                print(f"We got motion from LD2410 but are in a timeout state. Only trust the PIR to turn lights on")
-                return None
-
-            return event
-        except BlockingIOError:
-            return None
-
-    def send_to_lamp(self, ftime, level):
+        # only marks the store dirty, the file is written after a quiet period
+        self.settings.update({
+            "brightness"      : self._brightness,
+            "lamp_brightness" : self._lamp_brightness,
+            "delay"           : self._delay,
+            "motion_enabled"  : self._motion_enabled,
+            "volume"          : self._volume,
+            "light_switch"    : self._light_switch,
+            "fan_switch"      : self._fan_switch,
+        })
+
+    def collect_metrics(self):
+        zone = {"zone": self.name}
+        yield "loop_iterations_total", "counter", "EventLoop wakeups", {"loop": self.name}, self.loop.iterations
+        yield "loop_errors_total", "counter", "EventLoop callbacks that raised", {"loop": self.name}, self.loop.errors
+        yield "fade_frames_total", "counter", "Levels issued by the fade engine", dict(zone, device="LED"), self.led_fader.frames
+        yield "fade_skipped_frames_total", "counter", "Fade frames skipped because they were late", dict(zone, device="LED"), self.led_fader.skipped_frames
+        yield "fade_errors_total", "counter", "Fade frame and done callbacks that raised", dict(zone, device="LED"), self.led_fader.errors
+        yield "settings_writes_total", "counter", "settings.json writes", zone, self.settings.writes
+        for actor in self.actors.values():
+            yield from queue_metrics(actor.stats(), dict(zone, device=actor.name))
+        for key, value in self.rf_decoder.stats.items():
+            yield f"rf_{key}_total", "counter", "RF codes, presses and holds", zone, value
+
+    def send_to_lamp(self, ftime, level, on_ack=None):
         ftime = int(ftime)
         level = int(level)
 
         cmd = f"LAMPSET {ftime} {level}"
 
-        try:
-            sock.sendto(cmd.encode(), (self.LAMP_CLIENT_IP, UDP_PORT));
-        except BlockingIOError:
-            return None
+        self._deliver("lamp", cmd, "lamp", on_ack)
 
-    def determine_client_addresses(self):
-        print("Finding Client IPs...")
-        if self.LAMP_CLIENT_IP == "":
-            print("Finding LAMP")
-            self.LAMP_CLIENT_IP = find_client_ip(self.LAMP_CLIENT_MAC)
-        if self.MOTION_CLIENT_IP == "":
-            print("Finding PIR Sensor")
-            self.MOTION_CLIENT_IP = find_client_ip(self.MOTION_CLIENT_MAC)
-        if self.LD2410_CLIENT_IP == "":
-            print("Finding LD2410 Sensor")
-            self.LD2410_CLIENT_IP = find_client_ip(self.LD2410_CLIENT_MAC)
-
-        print("Found client Ips")
-        print(f"LAMP_CLIENT[{self.LAMP_CLIENT_MAC}] : {self.LAMP_CLIENT_IP}")
-        print(f"MOTION_CLIENT[{self.MOTION_CLIENT_MAC}] : {self.MOTION_CLIENT_IP}")
-        print(f"LD2410_CLIENT[{self.LD2410_CLIENT_MAC}] : {self.LD2410_CLIENT_IP}")
+    def send_pwm(self, cmd, key="pwm"):
+        # SET_PWM steps and FADEs share a key, only the newest is retried
+        self.send("pwm", cmd, key)
+
+    def send_ir(self, cmd, on_ack=None):
+        if cmd.startswith("IR_FAN"):
+            key = "fan"
+        elif cmd.startswith("IR_LIGHT"):
+            key = "light"
+        else:
+            key = cmd
+        self.send("ir", cmd, key, on_ack)
+
+    def send(self, kind, cmd, key=None, on_ack=None):
+        # queued on the device's actor, sent from the zone loop
+        self.actors[kind].submit(key if key is not None else cmd, (cmd, key, on_ack))
+
+    def _deliver(self, kind, cmd, key=None, on_ack=None):
+        # zones without a device of this kind simply have nothing to drive
+        device = self.zone.device(kind)
+        if device is not None and device.ip:
+            self.delivery.send(device.name, device.ip, UDP_PORT, cmd, key, on_ack)
+        elif on_ack is not None:
+            on_ack(None)
+
+
+
+REMOTE_DELAY = 0.25
+
+def sound_up(lights): return lights.sound_up
+def sound_down(lights): return lights.sound_down
+def sound_bad_input(lights): return lights.sound_bad_input
+
+# while an RF button is held
+RAMP = RepeatPolicy("ramp")
+LAMP_REPEAT = RepeatPolicy("repeat", interval=0.2)
+VOLUME_REPEAT = RepeatPolicy("repeat", interval=0.3)
+
+def remote(name, handler, sound=sound_bad_input, rf_codes=(), repeat=None, hold=None, sound_first=False):
+    command = Command(name, handler, sound, rate_limit=REMOTE_DELAY, rate_group="remote",
+                      persist=True, rf_codes=rf_codes, hold=hold, sound_first=sound_first)
+    if repeat is not None:
+        command.repeat = repeat
+    return COMMANDS.add(command)
+
+def scene(name, sound=sound_up, rf_codes=()):
+    # the sound compares the levels before the scene replaces them
+    return remote(name, LightClients.cmd_scene, sound, rf_codes=rf_codes, sound_first=True)
+
+def motion(name):
+    return COMMANDS.add(Command(name, LightClients.cmd_motion, kind="motion"))
+
+# power and motion scenes only restore the saved levels, presets replace them
+SCENES = SceneRegistry()
+SCENES.add(Scene("ON", led=SAVED, lamp=SAVED, on_off=True))
+SCENES.add(Scene("OFF", led=0, lamp=0, power=False, on_off=True))
+SCENES.add(Scene("MOTION_OFF", led=1, lamp=1, duration=3, power=False, on_off=True))
+SCENES.add(Scene("BRIGHTNESS_MIN", led=1, lamp=5))
+SCENES.add(Scene("BRIGHTNESS_75", led=60, lamp=60))
+# slow scenes for automations.json; the lamp is left alone, it would ignore
+# every command for the whole fade
+SCENES.add(Scene("EVENING_DIM", led=20, duration=10*60))
+SCENES.add(Scene("MORNING_RAMP", led=60, duration=20*60))
+
+COMMANDS = CommandRegistry()
+remote("POWER_BUTTON", LightClients.cmd_power_button,
+       lambda l: l.sound_up if l._power_state else l.sound_down, rf_codes=(59137,))
+remote("STOP_BUTTON", LightClients.cmd_stop_button,
+       lambda l: l.sound_up if l._motion_enabled else l.sound_down, rf_codes=(59139,))
+remote("BRIGHTNESS_UP", LightClients.cmd_brightness_up, sound_up, rf_codes=(59140,),
+       repeat=RAMP, hold=LightClients.hold_brightness)
+remote("LAMP_UP", LightClients.cmd_lamp_up,
+       lambda l: l.sound_bad_input if l._lamp_brightness > 75 else l.sound_up, rf_codes=(59141,),
+       repeat=LAMP_REPEAT, hold=LightClients.hold_lamp)
+scene("BRIGHTNESS_75", lambda l: l.sound_level(l._brightness, 75, bad_if=75), rf_codes=(59142,))
+remote("BRIGHTNESS_DOWN", LightClients.cmd_brightness_down, sound_down, rf_codes=(59143,),
+       repeat=RAMP, hold=LightClients.hold_brightness)
+remote("LAMP_DOWN", LightClients.cmd_lamp_down,
+       lambda l: l.sound_bad_input if l._lamp_brightness <= 0 else l.sound_down, rf_codes=(59144,),
+       repeat=LAMP_REPEAT, hold=LightClients.hold_lamp)
+scene("BRIGHTNESS_MIN", lambda l: l.sound_bad_input if l._brightness == 1 else l.sound_up, rf_codes=(59145,))
+scene("EVENING_DIM")
+scene("MORNING_RAMP")
+remote("VOLUME_UP", LightClients.cmd_volume_up, sound_up, rf_codes=(59150,), repeat=VOLUME_REPEAT)
+remote("DELAY_30S", LightClients.cmd_delay, LightClients.sound_delay, rf_codes=(59152,))
+remote("VOLUME_DOWN", LightClients.cmd_volume_down, sound_down, rf_codes=(59153,), repeat=VOLUME_REPEAT)
+remote("DELAY_1H", LightClients.cmd_delay, LightClients.sound_delay, rf_codes=(59154,))
+remote("DELAY_3H", LightClients.cmd_delay, LightClients.sound_delay)
+remote("DELAY_10M", LightClients.cmd_delay, LightClients.sound_delay, rf_codes=(59156,))
+remote("IR_FAN_STOP", LightClients.cmd_ir, sound_down)
+remote("IR_LIGHT_ON", LightClients.cmd_ir, sound_up)
+remote("IR_LIGHT_OFF", LightClients.cmd_ir, sound_down)
+remote("IR_FAN_LOW", LightClients.cmd_ir, sound_up)
+remote("IR_FAN_MID", LightClients.cmd_ir, sound_up)
+remote("IR_FAN_HIGH", LightClients.cmd_ir, sound_up)
+remote("MUSIC_BUTTON", LightClients.cmd_none)
+remote("LIGHT_SWITCH", LightClients.cmd_light_switch)
+remote("FAN_SWITCH", LightClients.cmd_fan_switch)
+motion("MOTION_DETECTED")
+motion("MOTIONLESS")
+# extra scenes, e.g. {"MOVIE": {"led": 10, "lamp": 0, "light": "IR_LIGHT_OFF"}}; bind
+# RF codes to them by name in commands.json
+for extra in SCENES.load_config(os.path.join(dir_path, "scenes.json")):
+    if COMMANDS.get(extra.name) is None:
+        scene(extra.name)
+COMMANDS.load_config(os.path.join(dir_path, "commands.json"))
+
+# time of day scenes, e.g. {"evening": {"at": "21:30", "scene": "EVENING_DIM", "only_if_on": true}}
+AUTOMATIONS = []
+for automation in load_automations(os.path.join(dir_path, "automations.json")):
+    if SCENES.get(automation.scene) is None:
+        print(f"Skipping automation {automation.name}: no scene {automation.scene}", level=WARNING)
+    else:
+        AUTOMATIONS.append(automation)
 
 
 class RF:
-    def __init__(self):
+    def __init__(self, on_cmd=None):
+        from rpi_rf import RFDevice # imported here so leds.py can be imported off the Pi
         self.rfdevice = None
+        self.on_cmd = on_cmd
         rf_pin = 27
         self.rfdevice = RFDevice(rf_pin)
+        # rpi_rf decodes codes inside its GPIO edge callback. Hook it before
+        # enable_rx registers it so new codes are pushed to us instead of polled.
+        self.rfdevice.rx_callback = self._rx_callback
         self.rfdevice.enable_rx()
         self._timestamp = None
         self._code = None
         self.cmd = None
 
-    def get_rf_cmd(self):
-        time.sleep(0.01)
+    def _rx_callback(self, gpio):
+        type(self.rfdevice).rx_callback(self.rfdevice, gpio)
         if self.rfdevice.rx_code_timestamp != self._timestamp:
             self._timestamp = self.rfdevice.rx_code_timestamp
             self._code = self.rfdevice.rx_code
@@ -701,116 +1199,149 @@ class RF:
             cmd = self.parse_code()
             if cmd is not None:
                 self.cmd = cmd
-            return cmd
-        return None
+                if self.on_cmd is not None:
+                    self.on_cmd(cmd)
 
     def parse_code(self):
-        cmd = None
-        match self._code:
-            case 59137:
-                cmd = "POWER_BUTTON"
-                print(f"Got remote command: 59137 for {cmd}")
-            case 59139:
-                cmd = "STOP_BUTTON"
-                print(f"Got remote command: 59139 for {cmd}")
-            case 59140:
-                cmd = "BRIGHTNESS_UP"
-                print(f"Got remote command: 59140 for {cmd}")
-            case 59141:
-                cmd = "LAMP_UP"
-                print(f"Got remote command: 59141 for {cmd}")
-            case 59142:
-                cmd = "BRIGHTNESS_75"
-                print(f"Got remote command: 59142 for {cmd}")
-            case 59143:
-                cmd = "BRIGHTNESS_DOWN"
-                print(f"Got remote command: 59143 for {cmd}")
-            case 59144:
-                cmd = "LAMP_DOWN"
-                print(f"Got remote command: 59144 for {cmd}")
-            case 59145:
-                cmd = "BRIGHTNESS_MIN"
-                print(f"Got remote command: 59145 for {cmd}")
-            case 59150:
-                cmd = "VOLUME_UP"
-                print(f"Got remote command: 59150 for {cmd}")
-            case 59152:
-                cmd = "DELAY_30S"
-                print(f"Got remote command: 59152 for {cmd}")
-            case 59153:
-                cmd = "VOLUME_DOWN"
-                print(f"Got remote command: 59153 for {cmd}")
-            case 59154:
-                cmd = "DELAY_1H"
-                print(f"Got remote command: 59154 for {cmd}")
-            case 59156:
-                cmd = "DELAY_10M"
-                print(f"Got remote command: 59156 for {cmd}")
-
-        if cmd is not None:
-            print(cmd)
-
-        return cmd
-
-
-
-def ping(host):
-    with Timer("Ping " + host):
-        try:
-            socket.inet_aton(host)
-        except socket.error:
-            return 0
-
-        command = ['ping', '-c', '1', host]
-        result = subprocess.run(command, stdout=subprocess.PIPE)
-        output = result.stdout.decode('utf8')
-        if "Request timed out." in output or "100% packet loss" in output or "Name or service not known" in output:
-            return 0
-        return 1
-
-def every_10():
-    if "start_t" not in globals():
-        global start_t
-        start_t = time.time()
-
+        command = COMMANDS.from_rf(self._code)
+        if command is None:
+            return None
 
-    if time.time() - start_t > 10:
-        del start_t
-        return True
-    else:
-        return False
+        print(f"Got remote command: {self._code} for {command.name}")
+        return command.name
 
 
 
 # Setup Server
 MY_IP = "192.168.50.39"
 UDP_PORT = 2390
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((MY_IP, UDP_PORT))
-sock.setblocking(False)
-
-# Start RF ISR
-print("Starting RF Library")
-rf = RF()
-
-# Start Light Client Class
-print("Starting Light Client Library")
-lights = LightClients()
-
-alive_time = time.time()
-
-print("Starting Loop")
-while True:
-    if time.time() - alive_time > 60:
-        print("led.py alive")
-        alive_time = time.time()
-
+UDP_RCVBUF = 256*1024
+HEARTBEAT_INTERVAL = 0.5 # seconds between snapshots to supervisor.py
+ZONE_HANG = 5 * HEARTBEAT_INTERVAL # a zone loop that has not ticked for this long is stuck
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40) # linux: kernel drop counter on each datagram
+sock = None
+loop = None
+rf = None
+
+def make_loop(name):
+    return EventLoop(lateness_histogram=metrics.histogram("timer_lateness_seconds",
+                                                          "Timer deadline to its callback running", loop=name))
+
+def queue_metrics(stats, labels):
+    # wait times are in the device_queue_wait_seconds histograms
+    yield "device_queue_depth", "gauge", "Commands waiting per device", labels, stats["depth"]
+    yield "device_queue_coalesced_total", "counter", "Queued commands replaced by a newer one", labels, stats["coalesced"]
+    yield "device_queue_dropped_total", "counter", "Queued commands dropped on a full queue", labels, stats["dropped"]
+    yield "device_queue_failed_total", "counter", "Queued commands that raised when sent", labels, stats["failed"]
+
+def open_socket(ip, port, fd=None):
+    # fd is a socket already bound by supervisor.py, so datagrams that arrive
+    # during a restart wait in its buffer instead of being refused
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if fd is None else socket.socket(fileno=fd)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+    except OSError:
+        pass
+    if fd is None:
+        s.bind((ip, port))
+    s.setblocking(False)
+    return s
+
+def on_udp_readable():
     with Timer("Main Loop", 0.05):
-
-        # Parse User Events
-        user_cmd = rf.get_rf_cmd()
-        lights.handle_event(user_cmd)
-
         # Parse client events
-        motion_data = lights.get_data(sock);
-        lights.handle_event(motion_data)
+        now = time.monotonic()
+        for event, device, addr in controller.receive_events(sock):
+            controller.dispatch(event, device, addr, now)
+
+def setup(ip=None, port=None, mixer=None, sock_fd=None, state=None):
+    """
+    Open the server socket, start the RF receiver and one LightClients per
+    zone, and register the shared work on a new EventLoop. The zone loops
+    are started here; the caller runs loop.run().
+    tests/bench.py uses this with loopback addresses and fake clients.
+    """
+    global MY_IP, UDP_PORT, sock, loop, rf, controller, started_at
+    if started_at is None:
+        started_at = time.monotonic()
+    MY_IP = ip or MY_IP
+    UDP_PORT = UDP_PORT if port is None else port
+    sock = open_socket(MY_IP, UDP_PORT, sock_fd)
+    UDP_PORT = sock.getsockname()[1]
+
+    loop = make_loop("main")
+
+    # Start RF ISR. Codes arrive on the GPIO thread and are handed to the loop.
+    print("Starting RF Library")
+    rf = RF(on_cmd=lambda cmd: controller.rf_zone.loop.call_soon_threadsafe(
+        controller.rf_zone.rf_decoder.feed, cmd, time.monotonic()))
+
+    # Start Light Client Class
+    print("Starting Light Client Library")
+    registry = load_registry(zones_path, CLIENT_IPS, CLIENT_MACS)
+    controller = Controller(registry, mixer, state)
+
+    # independent startup work runs alongside the loop instead of before it:
+    # the mixer volume is read and sounds decode on their own thread, the
+    # saved state is pushed to the clients as each zone loop's first callback
+    threading.Thread(target=controller.load_audio, name="load-audio", daemon=True).start()
+    controller.sync_devices()
+    controller.start()
+    loop.call_soon_threadsafe(report_ready)
+
+    loop.add_reader(sock, on_udp_readable)
+    controller.health.attach(loop)
+    metrics.add_collector(controller.collect_metrics)
+    loop.call_every(metrics_interval, metrics.write_textfile, metrics_path)
+    loop.call_every(60, controller.check_clients)
+    # pick up PWM firmware upgrades/downgrades without a restart
+    loop.call_every(600, controller.probe_pwm_caps)
+    return controller
+
+def report_ready():
+    ready = time.monotonic() - started_at
+    metrics.gauge("startup_seconds", "Startup to the event loop running").set(round(ready, 3))
+    print(f"Ready for events {ready * 1000:.0f} ms after startup")
+
+def heartbeat(fd):
+    # only beat while every zone loop turns as well as this one; without
+    # beats supervisor.py kills and restarts the worker
+    stale = controller.stale_zones(ZONE_HANG)
+    if stale:
+        print(f"Zone loops {', '.join(stale)} stuck, holding back the heartbeat", level=WARNING)
+        return
+    # one JSON snapshot per line; lines below PIPE_BUF are written atomically
+    try:
+        os.write(fd, (json.dumps(controller.snapshot()) + "\n").encode())
+    except BlockingIOError:
+        pass # supervisor is behind, the next beat will do
+    except OSError:
+        pass # not supervised any more
+
+def main():
+    global logger, notifier, started_at
+    started_at = time.monotonic()
+    # log rotation and pruning of old logs is handled by the logger thread
+    logger = configure_logger(log_path, level=log_level_from_env())
+    atexit.register(onClose)
+    # repeated restarts within 5 minutes are sent as one "restarted 7× in 5 min"
+    notifier = Notifier(state_path=os.path.join(log_path, "notify.json"), window=300)
+    notify("leds.py restarted")
+
+    # set by supervisor.py
+    sock_fd = os.environ.get("ELLIED_SOCKET_FD")
+    state = os.environ.get("ELLIED_STATE")
+    heartbeat_fd = os.environ.get("ELLIED_HEARTBEAT_FD")
+
+    setup(sock_fd=int(sock_fd) if sock_fd else None, state=json.loads(state) if state else None)
+    metrics.add_collector(lambda: ((f"notifications_{key}_total", "counter", "Notifications by outcome", {}, value)
+                                   for key, value in notifier.stats().items() if key != "pending"))
+    if heartbeat_fd:
+        os.set_blocking(int(heartbeat_fd), False)
+        loop.call_every(HEARTBEAT_INTERVAL, heartbeat, int(heartbeat_fd))
+    print("Starting Loop")
+    loop.run()
+
+if __name__ == "__main__":
+    main()
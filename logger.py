@@ -0,0 +1,183 @@
+import builtins
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+_logger = None
+
+
+class Logger:
+    """
+    Queue backed log writer. Callers only format the message and enqueue it;
+    a background thread keeps the log file open, writes in batches, echoes
+    to stdout, rotates by size and age and prunes old files.
+    """
+
+    def __init__(self, log_path, level=INFO, max_bytes=10*1024*1024, max_age=86400,
+                 keep=10, echo=True, max_queue=10000):
+        self.log_path = log_path
+        self.level = level
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.echo = echo
+        self.dropped = 0
+        self.write_errors = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._file_size = 0
+        self._file_opened = 0
+        self._stamp_second = None
+        self._stamp = ""
+
+        os.makedirs(self.log_path, exist_ok=True)
+        self._open_new(prune=False) # old logs are pruned by the writer thread
+        self._thread = threading.Thread(target=self._run, name="logger", daemon=True)
+        self._thread.start()
+
+    def log(self, level, *args, sep=" ", end="\n"):
+        if level < self.level:
+            return
+        try:
+            self._queue.put_nowait((time.time(), sep.join(map(str, args)) + end))
+        except queue.Full:
+            self.dropped += 1
+
+    def set_level(self, level):
+        self.level = level
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        # never hang at exit on a full queue
+        try:
+            self._queue.put(None, timeout=2)
+        except queue.Full:
+            return
+        self._thread.join(timeout=2)
+
+    def _format_stamp(self, t):
+        second = int(t)
+        if second != self._stamp_second:
+            self._stamp_second = second
+            self._stamp = time.strftime("[%Y.%m.%d.%H.%M.%S] ", time.localtime(second))
+        return self._stamp
+
+    def _open_new(self, prune=True):
+        rotating = self._file is not None
+        if rotating:
+            self._file.close()
+            self._file = None
+        name = time.strftime("%Y.%m.%d.%H.%M.%S")
+        path = os.path.join(self.log_path, name + ".log")
+        n = 1
+        while rotating and os.path.exists(path):
+            # size rotation can happen more than once a second
+            path = os.path.join(self.log_path, f"{name}.{n}.log")
+            n += 1
+        self._file = open(path, 'a')
+        self._file_size = self._file.tell()
+        self._file_opened = time.monotonic()
+        if prune:
+            self._prune()
+
+    def _prune(self):
+        logs = []
+        for name in os.listdir(self.log_path):
+            if name.endswith(".log"):
+                path = os.path.join(self.log_path, name)
+                try:
+                    logs.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+
+        logs.sort()
+        for mtime, path in logs[:-self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _run(self):
+        self._prune()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 512:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = batch[-1] is None
+            text = "".join(self._format_stamp(item[0]) + item[1] for item in batch if item is not None)
+
+            if self.dropped:
+                text += self._format_stamp(time.time()) + f"[logger dropped {self.dropped} lines]\n"
+                self.dropped = 0
+
+            try:
+                self._write(text)
+            except (OSError, ValueError) as e:
+                # disk full or the log directory gone: keep the thread, try
+                # a new file with the next batch
+                self.write_errors += 1
+                sys.stderr.write(f"logger: could not write {self.log_path}: {e}\n")
+                if self._file is not None:
+                    try:
+                        self._file.close()
+                    except OSError:
+                        pass
+                self._file = None
+            for _ in batch:
+                self._queue.task_done()
+
+            if closing:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _write(self, text):
+        if not text:
+            return
+        if self._file is None:
+            # after a failed write
+            os.makedirs(self.log_path, exist_ok=True)
+            self._open_new(prune=False)
+        self._file.write(text)
+        self._file.flush()
+        self._file_size += len(text)
+        if self.echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        if self._file_size > self.max_bytes or time.monotonic() - self._file_opened > self.max_age:
+            self._open_new()
+
+
+def configure(log_path, **kwargs):
+    global _logger
+    _logger = Logger(log_path, **kwargs)
+    return _logger
+
+
+def log(level, *args, sep=" ", end="\n"):
+    if _logger is None:
+        if level >= INFO:
+            builtins.print(*args, sep=sep, end=end)
+        return
+    _logger.log(level, *args, sep=sep, end=end)
+
+
+def level_from_env(default="INFO"):
+    return LEVELS.get(os.environ.get("ELLIED_LOG_LEVEL", default).upper(), INFO)
@@ -0,0 +1,201 @@
+import bisect
+import os
+import threading
+import time
+
+from logger import log, WARNING
+
+# seconds, for block timings and latencies
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Fixed upper bounds; counts are per bucket and made cumulative on export."""
+    __slots__ = ("bounds", "counts", "count", "sum", "max", "_lock")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1) # last is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q, None if empty."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, n in zip(self.bounds + (self.max,), counts):
+            seen += n
+            if seen >= rank:
+                return round(min(bound, self.max), 6)
+        return round(self.max, 6)
+
+    def quantile_ms(self, q):
+        value = self.quantile(q)
+        return round(value * 1000, 2) if value is not None else None
+
+
+class Registry:
+    """
+    Named counters, gauges and histograms, optionally labelled. Instruments
+    are created once and updated in place, so the hot path is an attribute
+    update. Numbers the daemon already keeps elsewhere (delivery stats, rx
+    stats, fader frames) are read at export time by collectors instead of
+    being copied on every update.
+    """
+
+    KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+    def __init__(self, prefix="ellied_"):
+        self.prefix = prefix
+        self.started = time.time()
+        self._metrics = {} # name -> (kind, help, {labels key: instrument})
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help, labels, **kwargs):
+        key = _labels_key(labels)
+        with self._lock:
+            entry = self._metrics.get(name)
+            if entry is None:
+                entry = self._metrics[name] = (kind, help, {})
+            elif entry[0] != kind:
+                raise ValueError(f"Metric {name} is a {entry[0]}, not a {kind}")
+            instrument = entry[2].get(key)
+            if instrument is None:
+                instrument = entry[2][key] = self.KINDS[kind](**kwargs)
+            return instrument
+
+    def counter(self, name, help="", **labels):
+        return self._get("counter", name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self._get("gauge", name, help, labels)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get("histogram", name, help, labels, bounds=buckets)
+
+    def add_collector(self, collector):
+        """collector() returns (name, kind, help, labels dict, value) tuples; kind is counter or gauge."""
+        self._collectors.append(collector)
+
+    def _samples(self):
+        with self._lock:
+            metrics = [(name, kind, help, dict(instruments)) for name, (kind, help, instruments) in self._metrics.items()]
+
+        collected = {}
+        for collector in self._collectors:
+            try:
+                for name, kind, help, labels, value in collector():
+                    entry = collected.setdefault(name, (kind, help, {}))
+                    entry[2][_labels_key(labels)] = value
+            except Exception as e:
+                log(WARNING, f"Metrics collector {collector} failed: {e}")
+        for name, (kind, help, values) in collected.items():
+            metrics.append((name, kind, help, values))
+        return sorted(metrics, key=lambda m: m[0])
+
+    def collect(self):
+        """Everything as a JSON friendly dict, for the STATS query."""
+        result = {"uptime_s": round(time.time() - self.started)}
+        for name, kind, help, instruments in self._samples():
+            values = {}
+            for key, instrument in instruments.items():
+                label = ",".join(f"{k}={v}" for k, v in key) or "value"
+                if kind == "histogram":
+                    values[label] = {"count": instrument.count,
+                                     "sum": round(instrument.sum, 6),
+                                     "p50": instrument.quantile(0.5),
+                                     "p99": instrument.quantile(0.99),
+                                     "max": round(instrument.max, 6)}
+                elif isinstance(instrument, (Counter, Gauge)):
+                    values[label] = instrument.value
+                else:
+                    values[label] = instrument
+            result[name] = values if len(values) != 1 or "value" not in values else values["value"]
+        return result
+
+    def render_prometheus(self):
+        lines = [f"# TYPE {self.prefix}uptime_seconds gauge",
+                 f"{self.prefix}uptime_seconds {time.time() - self.started:.0f}"]
+        for name, kind, help, instruments in self._samples():
+            full = self.prefix + name
+            if help:
+                lines.append(f"# HELP {full} {help}")
+            lines.append(f"# TYPE {full} {kind}")
+            for key, instrument in instruments.items():
+                if kind == "histogram":
+                    with instrument._lock:
+                        counts = list(instrument.counts)
+                        total, total_sum = instrument.count, instrument.sum
+                    cumulative = 0
+                    for bound, n in zip(instrument.bounds + ("+Inf",), counts):
+                        cumulative += n
+                        lines.append(f"{full}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{full}_sum{_format_labels(key)} {total_sum}")
+                    lines.append(f"{full}_count{_format_labels(key)} {total}")
+                else:
+                    value = instrument.value if isinstance(instrument, (Counter, Gauge)) else instrument
+                    lines.append(f"{full}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Atomically replace path, for the node_exporter textfile collector."""
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp, path)
+        except OSError as e:
+            log(WARNING, f"Could not write metrics to {path}: {e}")
+
+
+REGISTRY = Registry()
@@ -0,0 +1,123 @@
+import re
+import subprocess
+import threading
+
+from logger import log, DEBUG, WARNING
+
+
+class AmixerMixer:
+    """
+    Volume through one long lived `amixer -s` session: commands are written to
+    its stdin instead of starting a process per change. set_volume() only
+    records the level, a worker thread applies the newest one, so a burst of
+    presses costs a single write.
+    """
+
+    def __init__(self, control="Speaker", card=None):
+        self.control = control
+        self.card = card
+        self.applied = 0
+        self._proc = None
+        self._cond = threading.Condition()
+        self._pending = None
+        self._thread = threading.Thread(target=self._run, name="mixer", daemon=True)
+        self._thread.start()
+
+    def _amixer(self, *args):
+        cmd = ["amixer"]
+        if self.card is not None:
+            cmd += ["-c", str(self.card)]
+        return cmd + list(args)
+
+    def get_volume(self):
+        try:
+            out = subprocess.run(self._amixer("sget", self.control), capture_output=True,
+                                 text=True, timeout=2).stdout
+        except (OSError, subprocess.TimeoutExpired) as e:
+            log(WARNING, f"Could not read {self.control} volume: {e}")
+            return None
+        match = re.search(r"\[(\d+)%\]", out)
+        return int(match.group(1)) if match else None
+
+    def set_volume(self, percent):
+        with self._cond:
+            self._pending = percent
+            self._cond.notify()
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=2)
+
+    def _session(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(self._amixer("-s"), stdin=subprocess.PIPE,
+                                          stdout=subprocess.DEVNULL, text=True)
+        return self._proc
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                percent = self._pending
+                self._pending = None
+
+            for attempt in range(2):
+                try:
+                    proc = self._session()
+                    proc.stdin.write(f"sset {self.control} {percent}%\n")
+                    proc.stdin.flush()
+                    self.applied += 1
+                    log(DEBUG, f"{self.control} set to {percent}%")
+                    break
+                except (OSError, ValueError) as e:
+                    # amixer exited, start a new session and retry once
+                    log(WARNING, f"amixer session failed: {e}")
+                    self._proc = None
+
+
+class AlsaMixer:
+    """Volume through the pyalsaaudio bindings, when they are installed."""
+
+    def __init__(self, control="Speaker", card=None):
+        import alsaaudio
+        kwargs = {} if card is None else {"cardindex": card}
+        self._mixer = alsaaudio.Mixer(control, **kwargs)
+        self.applied = 0
+
+    def get_volume(self):
+        return int(self._mixer.getvolume()[0])
+
+    def set_volume(self, percent):
+        self._mixer.setvolume(int(percent))
+        self.applied += 1
+
+    def close(self):
+        self._mixer.close()
+
+
+class FakeMixer:
+    def __init__(self, volume=70):
+        self.volume = volume
+        self.history = []
+        self.applied = 0
+
+    def get_volume(self):
+        return self.volume
+
+    def set_volume(self, percent):
+        self.volume = percent
+        self.history.append(percent)
+        self.applied += 1
+
+    def close(self):
+        pass
+
+
+def make_mixer(control="Speaker"):
+    try:
+        return AlsaMixer(control)
+    except Exception as e: # not installed, or no such control
+        log(DEBUG, f"pyalsaaudio mixer unavailable ({e}), using amixer session")
+        return AmixerMixer(control)
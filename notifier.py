@@ -0,0 +1,202 @@
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+
+from logger import log, DEBUG, INFO, WARNING
+
+JOIN = "/usr/local/bin/join.py"
+
+
+class JoinSink:
+    """Push notifications through join.py, killed after timeout seconds."""
+
+    def __init__(self, path=JOIN, timeout=10):
+        self.path = path
+        self.timeout = timeout
+
+    def __call__(self, text):
+        subprocess.run([self.path, "--text", text], timeout=self.timeout, check=False,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class FileSink:
+    """Appends notifications to a local file, one per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, text):
+        with open(self.path, 'a') as f:
+            f.write(f"{time.strftime('%Y.%m.%d.%H.%M.%S')} {text}\n")
+
+
+class ListSink:
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, text):
+        self.sent.append(text)
+
+
+def make_sink(spec=None):
+    """ELLIED_NOTIFY: unset or "join" for join.py, "file:<path>", or "log" to only log."""
+    spec = spec if spec is not None else os.environ.get("ELLIED_NOTIFY", "join")
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec == "log":
+        return lambda text: log(INFO, f"Notification: {text}")
+    return JoinSink()
+
+
+def _span(seconds):
+    if seconds < 90:
+        return f"{seconds:.0f} s"
+    return f"{seconds / 60:.0f} min"
+
+
+class Notifier:
+    """
+    Sends notifications from a background thread, so nobody waits on the
+    sink. notify() only puts the text on a bounded queue; when it is full
+    the text is dropped.
+
+    Identical texts are sent at most once per window seconds. Repeats in
+    the window are counted and sent as one summary when it ends, e.g.
+    "leds.py restarted 7× in 5 min". The counts are kept in state_path, so
+    a crash loop of short lived processes is coalesced too: the summary
+    goes out from whichever process is running when the window ends, or
+    with the next occurrence after it.
+    """
+
+    def __init__(self, sink=None, state_path=None, window=300, max_queue=16):
+        self.sink = sink if sink is not None else make_sink()
+        self.state_path = state_path
+        self.window = window
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._cond = threading.Condition()
+        self._unfinished = 0
+        self._state = self._load() # text -> {"sent": time, "count": n, "first": time, "last": time}
+        self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self._thread.start()
+
+    def notify(self, text):
+        with self._cond:
+            self._unfinished += 1
+        try:
+            self._queue.put_nowait((time.time(), text))
+        except queue.Full:
+            self._finished()
+            self.dropped += 1
+            log(WARNING, f"Notification queue full, dropping: {text}")
+
+    def flush(self, timeout=2):
+        """Wait up to timeout seconds for queued texts to be handled. Returns True if they were."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._unfinished:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def stats(self):
+        return {"sent": self.sent, "coalesced": self.coalesced, "dropped": self.dropped,
+                "failed": self.failed, "pending": {text: entry["count"] for text, entry in self._state.items()
+                                                   if entry["count"]}}
+
+    def _finished(self):
+        with self._cond:
+            self._unfinished -= 1
+            self._cond.notify_all()
+
+    def _load(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                return {text: dict(entry) for text, entry in json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            log(WARNING, f"Ignoring notification state {self.state_path}: {e}")
+            return {}
+
+    def _save(self):
+        if self.state_path is None:
+            return
+        tmp = f"{self.state_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f)
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            log(WARNING, f"Could not write notification state {self.state_path}: {e}")
+
+    def _next_due(self):
+        due = [entry["sent"] + self.window for entry in self._state.values() if entry["count"]]
+        return min(due) if due else None
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            timeout = None if due is None else max(0, due - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if self.state_path is not None:
+                # another process (the previous or next worker) may have sent or counted since
+                self._state = self._load()
+            now = time.time()
+            changed = self._send_due(now)
+            if item is not None:
+                changed = self._handle(*item) or changed
+            if changed:
+                self._save()
+            if item is not None:
+                self._finished()
+
+    def _handle(self, at, text):
+        entry = self._state.get(text)
+        if entry is not None and at - entry["sent"] < self.window:
+            entry["count"] += 1
+            entry["first"] = entry["first"] or at
+            entry["last"] = at
+            self.coalesced += 1
+            log(DEBUG, f"Coalesced notification {text} ({entry['count']} in window)")
+            return True
+
+        # a summary still owed for an earlier window has gone out in _send_due
+        self._send(text, text, at)
+        return True
+
+    def _send_due(self, now):
+        changed = False
+        for text, entry in list(self._state.items()):
+            if now - entry["sent"] < self.window:
+                continue
+            if entry["count"]:
+                span = max(entry["last"] - entry["first"], 1)
+                self._send(f"{text} {entry['count']}× in {_span(span)}", text, now)
+            else:
+                del self._state[text]
+            changed = True
+        return changed
+
+    def _send(self, message, text, now):
+        self._state[text] = {"sent": now, "count": 0, "first": None, "last": None}
+        try:
+            self.sink(message)
+            self.sent += 1
+            log(DEBUG, f"Sent notification: {message}")
+        except (OSError, subprocess.SubprocessError) as e:
+            self.failed += 1
+            log(WARNING, f"Notification failed: {e}")
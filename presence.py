@@ -0,0 +1,129 @@
+import collections
+import time
+
+from logger import log, DEBUG, INFO
+
+
+class Source:
+    """
+    A presence sensor. A detection counts with weight for hold seconds.
+    A "MOTIONLESS" report ends the hold early.
+    """
+
+    def __init__(self, name, weight, hold):
+        self.name = name
+        self.weight = weight
+        self.hold = hold
+        self.last_seen = None
+        self.detections = 0
+
+    def active(self, now):
+        return self.last_seen is not None and now - self.last_seen <= self.hold
+
+    def held_until(self):
+        return None if self.last_seen is None else self.last_seen + self.hold
+
+
+class PresenceEngine:
+    """
+    Fuses the PIR and LD2410 streams into presence/absence transitions.
+
+    A detection raises the weighted score of all sources still inside their
+    hold time; when it reaches wake_threshold on_present() is called. Every
+    detection also pushes the absence deadline to (end of the latest hold +
+    interval()), and on_absent() fires from an EventLoop timer exactly at that
+    deadline, whether or not more packets arrive. The one timer is moved to
+    the new deadline on every detection.
+    """
+
+    def __init__(self, loop, sources, interval, on_present, on_absent, wake_threshold=1.0):
+        self.loop = loop
+        self.sources = {source.name: source for source in sources}
+        self.interval = interval
+        self.on_present = on_present
+        self.on_absent = on_absent
+        self.wake_threshold = wake_threshold
+
+        self.last_activity = time.monotonic()
+        self.absent = False
+        self._timer = None
+        self.time_to_on = collections.deque(maxlen=100)
+        self.time_to_dim = collections.deque(maxlen=100)
+
+    def score(self, now):
+        return sum(s.weight for s in self.sources.values() if s.active(now))
+
+    def deadline(self):
+        held = [s.held_until() for s in self.sources.values() if s.last_seen is not None]
+        return max(held + [self.last_activity]) + self.interval()
+
+    def touch(self, at=None):
+        """Activity that is not a sensor detection, e.g. a remote press or startup grace."""
+        self.last_activity = time.monotonic() if at is None else at
+        self.absent = False
+        self.rearm()
+
+    def detection(self, name, event_time=None):
+        now = time.monotonic()
+        source = self.sources[name]
+        source.last_seen = now
+        source.detections += 1
+        self.last_activity = max(self.last_activity, now)
+
+        score = self.score(now)
+        if score >= self.wake_threshold:
+            self.absent = False
+            if self.on_present():
+                latency = time.monotonic() - (event_time if event_time is not None else now)
+                self.time_to_on.append(latency)
+                log(INFO, f"Presence from {name} (score {score:.2f}), lights on after {latency * 1000:.1f} ms")
+        else:
+            log(DEBUG, f"Presence from {name} below wake threshold (score {score:.2f})")
+        self.rearm()
+
+    def clear(self, name):
+        source = self.sources[name]
+        now = time.monotonic()
+        if source.active(now):
+            source.last_seen = now - source.hold
+
+    def rearm(self):
+        """Move the absence timer to the current deadline."""
+        deadline = self.deadline()
+        if self._timer is None:
+            self._timer = self.loop.call_at(deadline, self._fire)
+        elif self._timer.deadline != deadline or not self._timer.active():
+            self._timer.reschedule_at(deadline)
+
+    def _fire(self):
+        now = time.monotonic()
+        deadline = self.deadline()
+        if now < deadline:
+            self.rearm() # the interval was lengthened
+            return
+
+        if not self.absent:
+            self.absent = True
+            if self.on_absent():
+                lateness = now - deadline
+                self.time_to_dim.append(lateness)
+                log(INFO, f"No presence for {self.interval()}s, dimmed {lateness * 1000:.1f} ms after the deadline")
+
+    def stats(self):
+        now = time.monotonic()
+
+        def summary(values):
+            values = sorted(values)
+            if not values:
+                return None
+            return {"n": len(values),
+                    "p50_ms": round(values[len(values) // 2] * 1000, 2),
+                    "max_ms": round(values[-1] * 1000, 2)}
+
+        return {"absent": self.absent,
+                "score": self.score(now),
+                "seconds_to_deadline": round(self.deadline() - now, 1),
+                "sources": {s.name: {"weight": s.weight, "hold": s.hold, "detections": s.detections,
+                                     "active": s.active(now)} for s in self.sources.values()},
+                "time_to_on": summary(self.time_to_on),
+                "time_to_dim": summary(self.time_to_dim)}
@@ -0,0 +1,89 @@
+import time
+
+from logger import log, DEBUG
+
+
+class Press:
+    __slots__ = ("name", "first", "last", "codes", "holding", "next_repeat")
+
+    def __init__(self, name, t):
+        self.name = name
+        self.first = t
+        self.last = t
+        self.codes = 1
+        self.holding = False
+        self.next_repeat = None
+
+
+class RFDecoder:
+    """
+    Turns the stream of RF codes into presses and holds.
+
+    A remote repeats its code for as long as a button is down, so codes for
+    the same button less than release_after apart belong to one press. The
+    first code is a "press" at once, so a tap costs no extra latency. If the
+    repeats go on for hold_after the press becomes a hold, and what happens
+    then depends on the button's RepeatPolicy (policy_for(name)): "once"
+    ignores the rest, "repeat" emits "repeat" every interval, "ramp" emits
+    "hold" and, when the codes stop, "release".
+
+    feed() and the timers run on the EventLoop; the RF ISR posts codes with
+    loop.call_soon_threadsafe. on_gesture(name, phase, event_time) is called
+    for every press/repeat/hold/release.
+    """
+
+    def __init__(self, loop, policy_for, on_gesture, hold_after=0.4, release_after=0.25, tick=0.05):
+        self.loop = loop
+        self.policy_for = policy_for
+        self.on_gesture = on_gesture
+        self.hold_after = hold_after
+        self.release_after = release_after
+        self.tick = tick
+
+        self.presses = {}
+        self.stats = {"codes": 0, "presses": 0, "holds": 0, "repeats": 0, "absorbed": 0}
+
+    def feed(self, name, t=None):
+        if t is None:
+            t = time.monotonic()
+        self.stats["codes"] += 1
+
+        press = self.presses.get(name)
+        if press is not None:
+            press.last = max(press.last, t)
+            press.codes += 1
+            self.stats["absorbed"] += 1
+            return
+
+        press = self.presses[name] = Press(name, t)
+        self.stats["presses"] += 1
+        self.loop.call_later(self.tick, self._check, press)
+        self.on_gesture(name, "press", t)
+
+    def _check(self, press):
+        if self.presses.get(press.name) is not press:
+            return
+        now = time.monotonic()
+        policy = self.policy_for(press.name)
+
+        if now - press.last >= self.release_after:
+            del self.presses[press.name]
+            log(DEBUG, f"RF {press.name} released after {now - press.first:.2f}s, {press.codes} codes")
+            if press.holding and policy.mode == "ramp":
+                self.on_gesture(press.name, "release", now)
+            return
+
+        if not press.holding and press.last - press.first >= self.hold_after:
+            press.holding = True
+            self.stats["holds"] += 1
+            if policy.mode == "ramp":
+                self.on_gesture(press.name, "hold", now)
+            elif policy.mode == "repeat":
+                press.next_repeat = now
+
+        if press.next_repeat is not None and now >= press.next_repeat:
+            press.next_repeat += policy.interval
+            self.stats["repeats"] += 1
+            self.on_gesture(press.name, "repeat", now)
+
+        self.loop.call_later(self.tick, self._check, press)
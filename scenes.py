@@ -0,0 +1,170 @@
+import collections
+import json
+import os
+import time
+
+from brightness import curve_table
+from logger import log, INFO, WARNING
+
+DEVICES = ("led", "lamp", "light", "fan")
+# a level target that means "the zone's saved brightness"
+SAVED = "saved"
+
+
+class Scene:
+    """
+    Targets for several devices of a zone, reached together over duration
+    seconds. led and lamp are levels 0-100 or SAVED, light and fan are IR
+    commands; None leaves a device alone. curve shapes the LED fade (see
+    brightness.CURVES). power sets the zone's power state, None leaves it.
+    A scene that is not on_off also becomes the saved brightness, like the
+    old presets did.
+
+    The targets are compiled once into the batch of (device, target) pairs
+    that apply() walks in a single pass.
+    """
+
+    __slots__ = ("name", "duration", "curve", "power", "on_off", "batch")
+
+    def __init__(self, name, led=None, lamp=None, light=None, fan=None, duration=1, curve="linear",
+                 power=True, on_off=False):
+        curve_table(curve) # unknown curves fail here rather than on first use
+        self.name = name
+        self.duration = duration
+        self.curve = curve
+        self.power = power
+        self.on_off = on_off
+        targets = {"led": led, "lamp": lamp, "light": light, "fan": fan}
+        self.batch = tuple((device, targets[device]) for device in DEVICES if targets[device] is not None)
+
+    @classmethod
+    def from_config(cls, name, spec):
+        unknown = set(spec) - set(DEVICES) - {"duration", "curve", "power", "on_off"}
+        if unknown:
+            raise ValueError(f"Scene {name} has unknown keys {sorted(unknown)}")
+        return cls(name, **spec)
+
+
+class SceneRegistry:
+    def __init__(self):
+        self.scenes = {}
+
+    def add(self, scene):
+        self.scenes[scene.name] = scene
+        return scene
+
+    def get(self, name):
+        return self.scenes.get(name)
+
+    def load_config(self, path):
+        """
+        Optional JSON scenes, added to (or replacing) the built-in ones:
+            {"MOVIE": {"led": 10, "lamp": 0, "light": "IR_LIGHT_OFF", "duration": 2}}
+        Returns the scenes that were loaded.
+        """
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+        loaded = []
+        for name, spec in config.items():
+            try:
+                loaded.append(self.add(Scene.from_config(name, spec)))
+            except (TypeError, ValueError) as e:
+                log(WARNING, f"Skipping scene {name}: {e}")
+        log(INFO, f"Loaded {len(loaded)} scenes from {path}")
+        return loaded
+
+
+class Run:
+    __slots__ = ("scene", "start", "pending", "times", "failed", "overridden", "outcome", "timeout")
+
+    def __init__(self, scene, start):
+        self.scene = scene
+        self.start = start
+        self.pending = set(device for device, _ in scene.batch)
+        self.times = {}
+        self.failed = []
+        self.overridden = []
+        self.outcome = None
+        self.timeout = None
+
+
+class SceneEngine:
+    """
+    Applies scenes to one zone. appliers maps each device to
+    fn(target, scene, start, done): start is the monotonic time shared by
+    every device of the scene, and done(ok) is called (from any thread) once
+    that device has reached its target, ok False if it never will and None
+    if a later command took the device over. When every device is done, or
+    timeout seconds after the scene should have finished, the run is
+    reported: the convergence time per device and in total. Applying a
+    scene supersedes the one still converging.
+    """
+
+    def __init__(self, loop, appliers, timeout=5, histogram=None):
+        self.loop = loop
+        self.appliers = appliers
+        self.timeout = timeout
+        self.histogram = histogram
+        self.current = None
+        self.history = collections.deque(maxlen=20)
+        self.counts = collections.Counter()
+
+    def apply(self, scene):
+        if self.current is not None:
+            self._finish(self.current, "superseded")
+        run = self.current = Run(scene, time.monotonic())
+        for device, target in scene.batch:
+            self.appliers[device](target, scene, run.start,
+                                  lambda ok, device=device: self.loop.call_soon_threadsafe(self._done, run, device, ok))
+        if run.pending:
+            run.timeout = self.loop.call_later(scene.duration + self.timeout, self._expire, run)
+        else:
+            self._finish(run, "converged")
+        return run
+
+    def _done(self, run, device, ok):
+        if run.outcome is not None or device not in run.pending:
+            return
+        run.pending.discard(device)
+        run.times[device] = time.monotonic() - run.start
+        if ok is False:
+            run.failed.append(device)
+        elif ok is None:
+            run.overridden.append(device)
+        if not run.pending:
+            if run.failed:
+                self._finish(run, "failed")
+            else:
+                self._finish(run, "superseded" if run.overridden else "converged")
+
+    def _expire(self, run):
+        run.timeout = None
+        self._finish(run, "timeout")
+
+    def _finish(self, run, outcome):
+        run.outcome = outcome
+        if run.timeout is not None:
+            run.timeout.cancel()
+        if self.current is run:
+            self.current = None
+        self.counts[outcome] += 1
+        total = time.monotonic() - run.start
+        devices = ", ".join(f"{device} {t:.2f}s" for device, t in run.times.items())
+        self.history.append({"scene": run.scene.name, "outcome": outcome, "seconds": round(total, 3),
+                             "devices": {device: round(t, 3) for device, t in run.times.items()},
+                             "failed": run.failed, "missing": sorted(run.pending)})
+        if outcome == "converged":
+            if self.histogram is not None:
+                self.histogram.observe(total)
+            log(INFO, f"Scene {run.scene.name} converged in {total:.2f}s ({devices})")
+        elif outcome != "superseded":
+            log(WARNING, f"Scene {run.scene.name} {outcome} after {total:.2f}s ({devices}); "
+                         f"failed {run.failed}, still pending {sorted(run.pending)}")
+
+    def stats(self):
+        return {"current": self.current.scene.name if self.current is not None else None,
+                "outcomes": dict(self.counts),
+                "recent": list(self.history)}
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+
+from logger import log, DEBUG, INFO, WARNING
+
+# name : (type, default)
+SCHEMA = {
+    "brightness"      : (int, 20),
+    "lamp_brightness" : (int, 20),
+    "delay"           : (int, 0),
+    "motion_enabled"  : (bool, True),
+    "volume"          : (int, 70),
+    "light_switch"    : (str, "IR_LIGHT_OFF"),
+    "fan_switch"      : (str, "IR_FAN_STOP"),
+}
+
+
+def parse_settings(raw, schema=SCHEMA):
+    """
+    Validate a loaded JSON dict against the schema. Older files stored keys as
+    "self._brightness"; those are mapped onto the plain names. Unknown keys and
+    values of the wrong type are dropped with a warning.
+    """
+    values = {name: default for name, (kind, default) in schema.items()}
+    for key, value in raw.items():
+        name = key[len("self._"):] if key.startswith("self._") else key
+        if name not in schema:
+            log(WARNING, f"Ignoring unknown setting {key}")
+            continue
+
+        kind = schema[name][0]
+        if kind is bool:
+            ok = isinstance(value, bool)
+        elif kind is int:
+            ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+            value = int(value) if ok else value
+        else:
+            ok = isinstance(value, kind)
+
+        if not ok:
+            log(WARNING, f"Ignoring setting {key} = {value!r}, expected {kind.__name__}")
+            continue
+        values[name] = value
+    return values
+
+
+class SettingsStore:
+    """
+    Write-behind settings file. update() only records the new values; a
+    background thread writes them once nothing has changed for quiet_period
+    seconds, via a temp file, fsync and rename so a power cut never leaves a
+    half written settings.json. A failed write is logged and retried after
+    another quiet period.
+    """
+
+    def __init__(self, path, schema=SCHEMA, quiet_period=2.0):
+        self.path = path
+        self.schema = schema
+        self.quiet_period = quiet_period
+        self.writes = 0
+        self.failed_writes = 0
+
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._last_change = 0
+        self.values = self.load()
+        self._saved = dict(self.values)
+
+        self._thread = threading.Thread(target=self._run, name="settings", daemon=True)
+        self._thread.start()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return parse_settings({}, self.schema)
+
+        try:
+            with open(self.path, 'r') as f:
+                raw = json.load(f)
+        except (OSError, ValueError) as e:
+            log(WARNING, f"Could not read {self.path}: {e}. Using defaults")
+            raw = {}
+
+        values = parse_settings(raw, self.schema)
+        log(INFO, f"Loaded settings {values}")
+        return values
+
+    def update(self, values):
+        with self._cond:
+            changed = {k: v for k, v in values.items() if self.values.get(k) != v}
+            if not changed:
+                return False
+            self.values.update(changed)
+            self._dirty = True
+            self._last_change = time.monotonic()
+            self._cond.notify()
+            return True
+
+    def flush(self):
+        """Returns False if the write failed; it is retried later."""
+        # the write lock orders snapshots with writes so an older snapshot
+        # can never overwrite a newer one
+        with self._write_lock:
+            with self._cond:
+                if not self._dirty:
+                    return True
+                values = dict(self.values)
+                self._dirty = False
+            if values == self._saved:
+                return True
+            try:
+                self._write_file(values)
+            except OSError as e:
+                self.failed_writes += 1
+                log(WARNING, f"Could not write {self.path}: {e}. Retrying in {self.quiet_period}s")
+                with self._cond:
+                    self._dirty = True
+                    self._last_change = time.monotonic()
+                return False
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                # wait for a quiet period, restarting it on every change
+                while self._dirty:
+                    remaining = self._last_change + self.quiet_period - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def _write_file(self, values):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(values, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self._saved = values
+        self.writes += 1
+        log(DEBUG, f"Saved settings {values}")
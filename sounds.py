@@ -0,0 +1,114 @@
+import collections
+import os
+import time
+import wave
+
+from actors import DeviceActor
+from logger import log, DEBUG, INFO, WARNING
+
+
+def load_wave(path):
+    """Returns the decoded sound and its length in seconds."""
+    import simpleaudio as sa # imported on first use so the module loads without audio
+    with wave.open(path, 'rb') as wav_file:
+        audio_data = wav_file.readframes(wav_file.getnframes())
+        seconds = wav_file.getnframes() / wav_file.getframerate()
+        return sa.WaveObject(audio_data, wav_file.getnchannels(),
+                             wav_file.getsampwidth(), wav_file.getframerate()), seconds
+
+
+class SoundBank:
+    """
+    WAV files decoded once into PCM buffers and played straight from memory.
+
+    Policies for a sound requested while another is playing:
+        preempt - stop the current sound and play the new one
+        queue   - play after the current one finishes (bounded, the oldest waiting is dropped)
+        mix     - play on top of the current one
+
+    Sounds are started by a DeviceActor on the loop given to attach(): a
+    newer preempting sound replaces one that has not started yet, and the
+    queue policy waits out each sound's length on a loop timer.
+    """
+
+    POLICIES = ("preempt", "queue", "mix")
+
+    def __init__(self, policy="preempt", max_queue=4, latency_histogram=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown sound policy {policy}, expected one of {self.POLICIES}")
+        self.policy = policy
+        self.sounds = {}
+        self.durations = {}
+        self.max_queue = max_queue
+        self.load_time = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=100)
+        self.latency_histogram = latency_histogram
+
+        self._current = None
+        self._actor = None
+
+    def attach(self, loop, wait_histogram=None):
+        self._actor = DeviceActor("audio", loop, self._handle, max_queue=self.max_queue,
+                                  wait_histogram=wait_histogram)
+
+    def load(self, paths):
+        start = time.perf_counter()
+        for path in paths:
+            if not os.path.exists(path):
+                log(WARNING, f"Sound {path} not found, skipping")
+                continue
+            try:
+                sound, self.durations[path] = load_wave(path)
+                self.sounds[path] = sound # last, play() looks the sound up first
+            except (wave.Error, EOFError) as e:
+                log(WARNING, f"Could not decode {path}: {e}")
+        self.load_time += time.perf_counter() - start
+        log(INFO, f"Decoded {len(self.sounds)} sounds in {self.load_time * 1000:.1f} ms")
+
+    def __contains__(self, path):
+        return path in self.sounds
+
+    def play(self, path, event_time=None):
+        sound = self.sounds.get(path)
+        if sound is None:
+            log(WARNING, f"Sound {path} not loaded")
+            return
+
+        item = (sound, self.durations[path], event_time)
+        if self._actor is None:
+            self._handle(item)
+        else:
+            # only preempting sounds replace each other, queued and mixed ones all play
+            self._actor.submit("sound" if self.policy == "preempt" else None, item)
+
+    def _handle(self, item):
+        sound, seconds, event_time = item
+        # runs on the RF zone's loop: a busy or missing ALSA device must
+        # cost the beep, never the remote
+        try:
+            if self.policy == "preempt" and self._current is not None:
+                self._current.stop()
+            self._start(sound, event_time)
+        except Exception as e: # simpleaudio raises its own SimpleaudioError
+            self.failed += 1
+            self._current = None
+            log(WARNING, f"Could not play sound: {e}")
+            return None
+        if self.policy == "queue":
+            return seconds
+        return None
+
+    def _start(self, sound, event_time):
+        self._current = sound.play()
+        if event_time is not None:
+            latency = time.monotonic() - event_time
+            self.latencies.append(latency)
+            if self.latency_histogram is not None:
+                self.latency_histogram.observe(latency)
+            log(DEBUG, f"Press to sound latency {latency * 1000:.1f} ms")
+        return self._current
+
+    def stats(self):
+        stats = self._actor.stats() if self._actor is not None else {}
+        return dict(stats, failed=stats.get("failed", 0) + self.failed)
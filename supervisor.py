@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""
+Keeps leds.py running and restarts it as soon as it exits or hangs.
+
+The supervisor owns the daemon's UDP socket and passes it to every worker,
+so remote and sensor packets that arrive during a restart are queued
+instead of refused. The worker's main event loop writes a JSON state
+snapshot to a pipe every HEARTBEAT_INTERVAL, but only while every zone's
+event loop has ticked recently too; no line for hang_timeout seconds means
+a loop is stuck and the worker is killed. The last snapshot is handed to
+the next worker (ELLIED_STATE) so power state, the motion countdown and
+in-flight fades carry on instead of starting cold.
+
+    python3 supervisor.py            # started by startup.sh
+"""
+import argparse
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from logger import log, INFO, WARNING
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+WORKER = os.path.join(dir_path, "leds.py")
+
+# same address leds.py serves on
+MY_IP = "192.168.50.39"
+UDP_PORT = 2390
+
+
+class Supervisor:
+    def __init__(self, ip=MY_IP, port=UDP_PORT, hang_timeout=10, startup_timeout=30,
+                 min_uptime=5, max_backoff=10):
+        self.hang_timeout = hang_timeout
+        self.startup_timeout = startup_timeout
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ip, port))
+
+        self.state = None
+        self.restarts = 0
+        self.proc = None
+        self._backoff = 0
+        self._stopping = False
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ,
+                   ELLIED_SOCKET_FD=str(self.sock.fileno()),
+                   ELLIED_HEARTBEAT_FD=str(write_fd))
+        if self.state is not None:
+            env["ELLIED_STATE"] = json.dumps(self.state)
+        else:
+            env.pop("ELLIED_STATE", None)
+
+        self.proc = subprocess.Popen([sys.executable, WORKER], env=env,
+                                     pass_fds=(self.sock.fileno(), write_fd))
+        os.close(write_fd)
+        return read_fd
+
+    def watch(self, read_fd):
+        """Follow heartbeats until the worker exits or hangs. Returns the reason."""
+        started = time.monotonic()
+        last_beat = None
+        buffer = b""
+        selector = selectors.DefaultSelector()
+        selector.register(read_fd, selectors.EVENT_READ)
+        try:
+            while True:
+                now = time.monotonic()
+                if last_beat is None:
+                    timeout = started + self.startup_timeout - now
+                else:
+                    timeout = last_beat + self.hang_timeout - now
+                if timeout <= 0:
+                    self.proc.kill()
+                    return f"no heartbeat for {now - (last_beat or started):.0f}s"
+
+                if not selector.select(timeout):
+                    continue
+                data = os.read(read_fd, 65536)
+                if not data:
+                    # the pipe closes when the worker exits
+                    return f"exit code {self.proc.wait()}"
+
+                last_beat = time.monotonic()
+                buffer += data
+                lines = buffer.split(b"\n")
+                buffer = lines.pop()
+                for line in reversed(lines):
+                    try:
+                        self.state = json.loads(line)
+                        break
+                    except ValueError:
+                        continue
+        finally:
+            selector.close()
+            os.close(read_fd)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+        while not self._stopping:
+            started = time.monotonic()
+            reason = self.watch(self.spawn())
+            self.proc.wait()
+            if self._stopping:
+                break
+
+            uptime = time.monotonic() - started
+            self.restarts += 1
+            # restart at once, unless the worker keeps dying straight away
+            if uptime < self.min_uptime:
+                self._backoff = min(self.max_backoff, max(0.1, self._backoff * 2))
+            else:
+                self._backoff = 0
+            log(WARNING, f"leds.py stopped after {uptime:.1f}s ({reason}), restart {self.restarts}"
+                         + (f" in {self._backoff:.1f}s" if self._backoff else ""))
+            if self._backoff:
+                time.sleep(self._backoff)
+        log(INFO, "Supervisor stopped")
+
+    def _terminate(self, signum, frame):
+        self._stopping = True
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run leds.py and restart it when it exits or hangs")
+    parser.add_argument("--ip", default=MY_IP)
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    parser.add_argument("--hang-timeout", type=float, default=10, help="seconds without a heartbeat")
+    args = parser.parse_args()
+
+    Supervisor(args.ip, args.port, hang_timeout=args.hang_timeout).run()
@@ -0,0 +1,95 @@
+import array
+import re
+import threading
+import time
+
+STATIONARY = 0
+MOVING = 1
+KINDS = {"Stationary": STATIONARY, "Moving": MOVING}
+
+# "Moving target: 80cm energy:60", possibly with a Stationary target on the same line
+TARGET_RE = re.compile(r"(Moving|Stationary)\D*?(\d+)\s*cm\D*?(\d+)")
+
+
+class SensorRing:
+    """
+    Fixed size ring of LD2410 samples (time, kind, distance cm, energy)
+    kept in preallocated arrays, so a sample costs no allocation and memory
+    use never grows. aggregate() down-samples into min/max/mean buckets.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.kinds = array.array('B', bytes(capacity))
+        self.distances = array.array('H', bytes(2 * capacity))
+        self.energies = array.array('H', bytes(2 * capacity))
+        self.count = 0
+        self.total = 0
+        self.unparsed = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def add(self, kind, distance, energy, t=None):
+        if t is None:
+            t = time.time()
+        with self._lock:
+            i = self._next
+            self.times[i] = t
+            self.kinds[i] = kind
+            self.distances[i] = min(distance, 0xFFFF)
+            self.energies[i] = min(energy, 0xFFFF)
+            self._next = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.total += 1
+
+    def add_line(self, line, t=None):
+        """Parse a sensor line. Returns the number of samples it contained."""
+        n = 0
+        for name, distance, energy in TARGET_RE.findall(line):
+            self.add(KINDS[name], int(distance), int(energy), t)
+            n += 1
+        if n == 0:
+            self.unparsed += 1
+        return n
+
+    def aggregate(self, window=60, resolution=1, now=None, max_buckets=120):
+        """
+        min/max/mean of distance and energy per kind for each resolution
+        second bucket in the last window seconds, oldest first.
+        """
+        if now is None:
+            now = time.time()
+        start = now - min(window, resolution * max_buckets)
+        buckets = {}
+        with self._lock:
+            for j in range(self.count):
+                i = (self._next - 1 - j) % self.capacity
+                t = self.times[i]
+                if t < start:
+                    break # samples are in time order
+                key = (int(t // resolution), self.kinds[i])
+                d, e = self.distances[i], self.energies[i]
+                b = buckets.get(key)
+                if b is None:
+                    buckets[key] = [1, d, d, d, e, e, e]
+                else:
+                    b[0] += 1
+                    b[1] = min(b[1], d); b[2] = max(b[2], d); b[3] += d
+                    b[4] = min(b[4], e); b[5] = max(b[5], e); b[6] += e
+
+        result = []
+        for (slot, kind), (n, dmin, dmax, dsum, emin, emax, esum) in sorted(buckets.items()):
+            result.append({"t": slot * resolution,
+                           "kind": "moving" if kind == MOVING else "stationary",
+                           "n": n,
+                           "distance": [dmin, dmax, round(dsum / n, 1)],
+                           "energy": [emin, emax, round(esum / n, 1)]})
+        return result
+
+    def stats(self, window=60, resolution=1):
+        return {"samples": self.total,
+                "stored": self.count,
+                "unparsed": self.unparsed,
+                "resolution": resolution,
+                "buckets": self.aggregate(window, resolution)}
@@ -0,0 +1,502 @@
+#!/usr/bin/python3
+"""
+Hardware-free replay and latency benchmark for leds.py.
+
+Runs the controller in-process with a fake RFDevice, fake PWM/lamp/IR
+clients (fake_clients.py) and fake sensor senders on loopback. Time inside
+the controller runs on a virtual clock, so idle gaps in a trace (a 30 s
+motion timeout, a 3 s lamp fade) are skipped instead of waited for.
+
+    python3 tests/bench.py replay tests/traces/evening.jsonl
+    python3 tests/bench.py replay logs/2026.10.17.12.15.03.log --max-p99-ms 20
+    python3 tests/bench.py throughput --seconds 3
+    python3 tests/bench.py sweep --max-drop 0.001
+
+Traces are JSON lines, one event each, t in seconds:
+
+    {"t": 0.0, "rf": 59140}
+    {"t": 1.5, "udp": "MOTION_DETECTED", "from": "MOTION"}
+    {"t": 2.0, "event": "BRIGHTNESS_UP"}
+    {"t": 3.0, "event": "BRIGHTNESS_UP", "hold": 1.5}
+
+"hold" keeps repeating the RF code every RF_REPEAT seconds, like a held
+button; the hold runs in real time.
+
+A leds.py log file can be replayed directly; remote codes and sensor
+events are recovered from its "Got remote command" / "Got event" lines.
+Exits non-zero when a --max-* limit is exceeded.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import client_ips
+import fake_clients
+import logger
+import mixer
+from telemetry import TARGET_RE
+
+LOOPBACK_IPS = {
+    "PWM_CLIENT_IP"    : "127.0.0.2",
+    "LAMP_CLIENT_IP"   : "127.0.0.3",
+    "IR_CLIENT_IP"     : "127.0.0.4",
+    "MOTION_CLIENT_IP" : "127.0.0.5",
+    "LD2410_CLIENT_IP" : "127.0.0.6",
+    "SWITCH_CLIENT_IP" : "127.0.0.7",
+}
+SENDERS = {"MOTION": "MOTION_CLIENT_IP", "LD2410": "LD2410_CLIENT_IP", "SWITCH": "SWITCH_CLIENT_IP"}
+# device names in the log; older logs used the "MOTION CLIENT" style names
+LOG_SOURCES = {"MOTION": "MOTION", "LD2410": "LD2410", "SWITCH": "SWITCH",
+               "MOTION CLIENT": "MOTION", "LD2410_CLIENT": "LD2410", "SWITCH_CLIENT": "SWITCH"}
+
+# modules whose clock is replaced by the virtual one
+CLOCKED = ("leds", "eventloop", "fader", "presence", "delivery", "commands", "health", "sounds", "rfinput",
+           "scenes", "automations", "actors")
+
+RF_REPEAT = 0.1 # seconds between codes while a remote button is held
+
+LD2410_LINE = "Moving target: 80cm energy:60 Stationary target: 85cm energy:40"
+
+
+class VirtualClock:
+    """
+    Drop-in for the time module: monotonic()/time() run at real speed plus
+    an offset that advance() jumps forward. sleep() waits for virtual time,
+    so sleepers wake as soon as the clock is advanced past their deadline.
+    """
+
+    def __init__(self):
+        self.offset = 0.0
+        self._cond = threading.Condition()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def monotonic(self):
+        return time.monotonic() + self.offset
+
+    def time(self):
+        return time.time() + self.offset
+
+    def sleep(self, seconds):
+        end = self.monotonic() + seconds
+        with self._cond:
+            while True:
+                left = end - self.monotonic()
+                if left <= 0:
+                    return
+                self._cond.wait(left)
+
+    def advance(self, seconds):
+        with self._cond:
+            self.offset += seconds
+            self._cond.notify_all()
+
+
+class FakeRFDevice:
+    """Stands in for rpi_rf.RFDevice. press() delivers a code like the GPIO ISR would."""
+
+    def __init__(self, gpio, **kwargs):
+        self.gpio = gpio
+        self.rx_code = None
+        self.rx_code_timestamp = None
+        self.rx_pulselength = 350
+        self.rx_proto = 1
+
+    def enable_rx(self):
+        pass
+
+    def rx_callback(self, gpio):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def press(self, code):
+        self.rx_code = code
+        self.rx_code_timestamp = time.monotonic_ns()
+        self.rx_callback(self.gpio)
+
+
+class FakePlayback:
+    def stop(self):
+        pass
+
+    def wait_done(self):
+        pass
+
+    def is_playing(self):
+        return False
+
+
+class FakeWaveObject:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def from_wave_file(cls, path):
+        return cls()
+
+    def play(self):
+        return FakePlayback()
+
+
+def install_fake_hardware():
+    rpi_rf = types.ModuleType("rpi_rf")
+    rpi_rf.RFDevice = FakeRFDevice
+    sys.modules["rpi_rf"] = rpi_rf
+
+    simpleaudio = types.ModuleType("simpleaudio")
+    simpleaudio.WaveObject = FakeWaveObject
+    simpleaudio.PlayObject = FakePlayback
+    sys.modules["simpleaudio"] = simpleaudio
+
+
+def free_port(ip="127.0.0.1"):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((ip, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 3)
+
+    return {"n": len(values), "p50_ms": pct(0.5), "p99_ms": pct(0.99), "max_ms": round(values[-1] * 1000, 3)}
+
+
+def load_trace(path):
+    with open(path, 'r') as f:
+        first = f.readline()
+        f.seek(0)
+        if first.lstrip().startswith("{"):
+            return [json.loads(line) for line in f if line.strip()]
+        return trace_from_log(f)
+
+
+STAMP_RE = re.compile(r"^\[(\d{4})\.(\d\d)\.(\d\d)\.(\d\d)\.(\d\d)\.(\d\d)\] ")
+RF_RE = re.compile(r"Got remote command: (\d+) for")
+EVENT_RE = re.compile(r"Got event : (?:\x1b\[\d+m)?(\w+)(?:\x1b\[0m)?\s+from: (?:\x1b\[\d+m)?(.+?)(?:\x1b\[0m)?\s*$")
+
+
+def trace_from_log(lines):
+    trace = []
+    start = None
+    for line in lines:
+        stamp = STAMP_RE.match(line)
+        if stamp is None:
+            continue
+        t = time.mktime(tuple(int(x) for x in stamp.groups()) + (0, 0, -1))
+        if start is None:
+            start = t
+
+        rf = RF_RE.search(line)
+        if rf is not None:
+            trace.append({"t": t - start, "rf": int(rf.group(1))})
+            continue
+        event = EVENT_RE.search(line)
+        if event is not None and event.group(2) in LOG_SOURCES:
+            trace.append({"t": t - start, "udp": event.group(1), "from": LOG_SOURCES[event.group(2)]})
+    return trace
+
+
+class Bench:
+    """leds.py running on a loopback network with fake clients and a virtual clock."""
+
+    def __init__(self, verbose=False):
+        self.tmp = tempfile.TemporaryDirectory(prefix="ellied-bench-")
+        self.log = logger.configure(os.path.join(self.tmp.name, "logs"),
+                                    level=logger.DEBUG if verbose else logger.WARNING, echo=verbose)
+        install_fake_hardware()
+        import leds
+        self.leds = leds
+
+        self.clock = VirtualClock()
+        for name in CLOCKED:
+            sys.modules[name].time = self.clock
+
+        client_ips.CLIENT_IPS.update(LOOPBACK_IPS)
+        port = free_port()
+        self.outputs = {"PWM": fake_clients.FakePWMClient(bind=LOOPBACK_IPS["PWM_CLIENT_IP"], port=port).start(),
+                        "LAMP": fake_clients.FakeLampClient(bind=LOOPBACK_IPS["LAMP_CLIENT_IP"], port=port).start(),
+                        "IR": fake_clients.FakeIRClient(bind=LOOPBACK_IPS["IR_CLIENT_IP"], port=port).start()}
+        self.senders = {}
+        for name, attr in SENDERS.items():
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind((LOOPBACK_IPS[attr], 0))
+            s.setblocking(False)
+            self.senders[name] = s
+
+        leds.LightClients.settings_path = os.path.join(self.tmp.name, "settings.json")
+        leds.zones_path = os.path.join(self.tmp.name, "zones.json") # none: one zone from CLIENT_IPS
+        self.controller = leds.setup("127.0.0.1", port, mixer=mixer.FakeMixer())
+        self.lights = self.controller.rf_zone
+        self.address = ("127.0.0.1", leds.UDP_PORT)
+        self.rfdevice = leds.rf.rfdevice
+        threading.Thread(target=leds.loop.run, name="leds-loop", daemon=True).start()
+        self.settle_startup()
+
+    def close(self):
+        self.leds.loop.stop()
+        for lights in self.controller.zones.values():
+            lights.loop.stop()
+        for client in self.outputs.values():
+            client.stop()
+        for s in self.senders.values():
+            s.close()
+        self.log.close()
+        self.tmp.cleanup()
+
+    def sync(self, timeout=5):
+        """Wait until the loops have run everything that is due now, timers included."""
+        # the main loop first: it hands received datagrams on to the zones
+        loops = [self.leds.loop] + [lights.loop for lights in self.controller.zones.values()]
+        for loop in loops:
+            done = threading.Event()
+            loop.call_soon_threadsafe(loop.call_later, 0, done.set)
+            if not done.wait(timeout):
+                return False
+        return True
+
+    def settle_startup(self):
+        # startup sends the initial PWM/lamp/IR state and a CAPS probe;
+        # skip past the startup motion grace and the lamp fade
+        self.advance(11)
+        self.quiet(0.2)
+
+    def advance(self, seconds):
+        self.clock.advance(seconds)
+        self.sync()
+
+    def quiet(self, period):
+        """Wait until no output client has received anything for period seconds."""
+        while True:
+            last = max((c.received[-1][0] for c in self.outputs.values() if c.received), default=0)
+            left = last + period - time.monotonic()
+            if left <= 0:
+                return
+            time.sleep(left)
+
+    def inject(self, entry):
+        if "rf" in entry or "event" in entry:
+            code = entry.get("rf")
+            if code is None:
+                command = self.leds.COMMANDS.get(entry["event"])
+                if command is None or not command.rf_codes:
+                    raise ValueError(f"{entry['event']} has no RF code to replay")
+                code = command.rf_codes[0]
+            self.rfdevice.press(int(code))
+            if entry.get("hold"):
+                threading.Thread(target=self.hold, args=(int(code), entry["hold"]), daemon=True).start()
+        else:
+            self.senders[entry.get("from", "MOTION")].sendto(entry["udp"].encode(), self.address)
+
+    def hold(self, code, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            time.sleep(RF_REPEAT)
+            self.rfdevice.press(code)
+
+    def output_marks(self):
+        return {name: len(client.received) for name, client in self.outputs.items()}
+
+    def first_output(self, marks, since, timeout):
+        """(device, arrival time) of the first command after marks, or None."""
+        deadline = time.monotonic() + timeout
+        while True:
+            first = None
+            for name, client in self.outputs.items():
+                for t, cmd in client.received[marks[name]:]:
+                    if cmd != "PING" and t >= since:
+                        if first is None or t < first[1]:
+                            first = (name, t)
+                        break
+            left = deadline - time.monotonic()
+            if first is not None or left <= 0:
+                return first
+            client = self.outputs["PWM"]
+            with client.arrived:
+                client.arrived.wait(min(left, 0.001))
+
+    def replay(self, trace, settle=0.25):
+        latencies = {"all": []}
+        no_output = 0
+        sent_before = self.delivery_sent()
+        received_before = self.output_marks()
+        start = time.monotonic()
+
+        prev = trace[0]["t"] if trace else 0
+        for entry in trace:
+            gap = entry["t"] - prev
+            prev = entry["t"]
+            if gap > 0:
+                self.advance(gap)
+
+            marks = self.output_marks()
+            t0 = time.monotonic()
+            self.inject(entry)
+            first = self.first_output(marks, t0, settle)
+            if first is None:
+                no_output += 1
+                continue
+            latency = first[1] - t0
+            kind = "rf" if "rf" in entry or "event" in entry else entry.get("from", "MOTION").lower()
+            latencies["all"].append(latency)
+            latencies.setdefault(f"{kind}->{first[0].lower()}", []).append(latency)
+            self.sync()
+
+        elapsed = time.monotonic() - start
+        self.quiet(0.1)
+        sent = self.delivery_sent() - sent_before
+        received = sum(len([c for _, c in client.received[received_before[name]:] if c != "PING"])
+                       for name, client in self.outputs.items())
+        return {"events": len(trace),
+                "wall_s": round(elapsed, 3),
+                "virtual_s": round(trace[-1]["t"] - trace[0]["t"], 1) if trace else 0,
+                "no_output": no_output,
+                "latency": {kind: percentiles(values) for kind, values in latencies.items()},
+                "packets": {"sent": sent, "received": received,
+                            "drop_rate": round(1 - received / sent, 4) if sent else 0.0},
+                "delivery": self.lights.delivery.stats()}
+
+    def delivery_sent(self):
+        return sum(channel["sent"] + channel["retries"] for channel in self.lights.delivery.stats().values())
+
+    def flood(self, seconds=3, rate=None, line=LD2410_LINE):
+        """
+        Send LD2410 lines for seconds, as fast as possible or at rate per
+        second. Returns sent/handled counts; handled are samples that reached
+        the telemetry ring.
+        """
+        s = self.senders["LD2410"]
+        data = line.encode()
+        samples = len(TARGET_RE.findall(line))
+        ring = self.lights.ld2410
+        before = ring.total
+        rx_before = dict(self.controller.rx_stats)
+
+        sent = 0
+        start = time.monotonic()
+        end = start + seconds
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            if rate is not None:
+                due = int((now - start) * rate)
+                if sent >= due:
+                    time.sleep(min(0.001, end - now))
+                    continue
+                burst = due - sent
+            else:
+                burst = 64
+            for _ in range(burst):
+                try:
+                    s.sendto(data, self.address)
+                    sent += 1
+                except BlockingIOError:
+                    break
+        send_time = time.monotonic() - start
+        self.sync()
+        time.sleep(0.05)
+        self.sync()
+
+        handled = (ring.total - before) // samples
+        rx = self.controller.rx_stats
+        return {"seconds": round(send_time, 3),
+                "sent": sent,
+                "handled": handled,
+                "offered_per_s": round(sent / send_time),
+                "handled_per_s": round(handled / send_time),
+                "drop_rate": round(1 - handled / sent, 4) if sent else 0.0,
+                "kernel_drops": rx["kernel_drops"] - rx_before["kernel_drops"],
+                "max_batch": rx["max_batch"]}
+
+    def sweep(self, start=500, factor=2, seconds=1, max_drop=0.001, limit=200000):
+        """Raise the offered rate until more than max_drop is lost. Returns the best sustained run."""
+        best = None
+        runs = []
+        rate = start
+        while rate <= limit:
+            run = self.flood(seconds, rate)
+            run["rate"] = rate
+            runs.append(run)
+            if run["drop_rate"] > max_drop:
+                break
+            best = run
+            rate *= factor
+        return {"max_sustained_per_s": best["handled_per_s"] if best else 0, "runs": runs}
+
+
+def report(result, as_json):
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        if isinstance(value, dict) and key != "delivery":
+            print(f"{key}:")
+            for k, v in value.items():
+                print(f"    {k:<20} {v}")
+        elif key != "delivery":
+            print(f"{key:<24} {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay traces and benchmark leds.py without hardware")
+    parser.add_argument("mode", choices=("replay", "throughput", "sweep"))
+    parser.add_argument("trace", nargs="?", help="JSON lines trace or leds.py log (replay)")
+    parser.add_argument("--seconds", type=float, default=3, help="flood duration (throughput)")
+    parser.add_argument("--rate", type=int, default=None, help="events per second, default as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the trace this many times")
+    parser.add_argument("--max-p99-ms", type=float, default=None)
+    parser.add_argument("--max-drop", type=float, default=None)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="echo the controller log")
+    args = parser.parse_args()
+
+    if args.mode == "replay" and args.trace is None:
+        parser.error("replay needs a trace")
+
+    bench = Bench(verbose=args.verbose)
+    failed = []
+    try:
+        if args.mode == "replay":
+            trace = load_trace(args.trace)
+            span = trace[-1]["t"] + 1 if trace else 0
+            trace = [dict(entry, t=entry["t"] + i * span) for i in range(args.repeat) for entry in trace]
+            result = bench.replay(trace)
+            p99 = (result["latency"]["all"] or {}).get("p99_ms")
+            if args.max_p99_ms is not None and p99 is not None and p99 > args.max_p99_ms:
+                failed.append(f"p99 {p99} ms > {args.max_p99_ms} ms")
+            drop = result["packets"]["drop_rate"]
+        elif args.mode == "throughput":
+            result = bench.flood(args.seconds, args.rate)
+            drop = result["drop_rate"]
+        else:
+            result = bench.sweep(max_drop=0.001 if args.max_drop is None else args.max_drop)
+            drop = None
+
+        if args.max_drop is not None and drop is not None and drop > args.max_drop:
+            failed.append(f"drop rate {drop} > {args.max_drop}")
+        report(result, args.json)
+    finally:
+        bench.close()
+
+    for failure in failed:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failed else 0)
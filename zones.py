@@ -0,0 +1,157 @@
+import json
+import os
+
+from logger import log, INFO, WARNING
+
+KINDS = ("pwm", "lamp", "ir", "motion", "ld2410", "switch")
+# a device sharing its address with another (IR and switch on one ESP) is
+# reported as the first of these, same order as the old source_names chain
+ADDR_PRIORITY = ("motion", "lamp", "ld2410", "ir", "switch", "pwm")
+
+
+class Device:
+    """options are the device's other settings from zones.json, e.g. a PWM output's "bits"."""
+    __slots__ = ("name", "kind", "zone", "ip", "mac", "options")
+
+    def __init__(self, name, kind, zone, ip=None, mac=None, options=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown device kind {kind} for {name}, expected one of {KINDS}")
+        self.name = name
+        self.kind = kind
+        self.zone = zone
+        self.ip = ip
+        self.mac = mac
+        self.options = options or {}
+
+
+class Zone:
+    """
+    One room: at most one device of each kind. rf marks the zone the RF
+    remote and the speaker belong to. settings is its settings file, None
+    for the default next to leds.py.
+    """
+
+    def __init__(self, name, rf=False, settings=None):
+        self.name = name
+        self.rf = rf
+        self.settings = settings
+        self.devices = {} # kind -> Device
+
+    def device(self, kind):
+        return self.devices.get(kind)
+
+
+class ZoneRegistry:
+    """
+    Every zone and device, indexed by device name and by IP address so a
+    datagram is routed to its zone with one dict lookup. Addresses change
+    when discovery re-resolves a MAC; the index is rebuilt and swapped in
+    whole, so readers on other threads never need a lock.
+    """
+
+    def __init__(self):
+        self.zones = {}
+        self.devices = {}
+        self._by_ip = {}
+
+    def add_zone(self, zone):
+        if zone.name in self.zones:
+            raise ValueError(f"Duplicate zone {zone.name}")
+        self.zones[zone.name] = zone
+        return zone
+
+    def add_device(self, zone, name, kind, ip=None, mac=None, options=None):
+        if name in self.devices:
+            raise ValueError(f"Duplicate device {name}")
+        if kind in zone.devices:
+            raise ValueError(f"Zone {zone.name} already has a {kind} device")
+        device = self.devices[name] = zone.devices[kind] = Device(name, kind, zone.name, ip, mac, options)
+        self._index()
+        return device
+
+    def _index(self):
+        by_ip = {}
+        for kind in ADDR_PRIORITY:
+            for zone in self.zones.values():
+                device = zone.devices.get(kind)
+                if device is not None and device.ip:
+                    by_ip.setdefault(device.ip, device)
+        self._by_ip = by_ip
+
+    def device(self, name):
+        return self.devices.get(name)
+
+    def by_addr(self, ip):
+        return self._by_ip.get(ip)
+
+    def set_ip(self, name, ip):
+        """Returns the old address, or ip itself if nothing changed."""
+        device = self.devices[name]
+        old = device.ip
+        if old != ip:
+            device.ip = ip
+            self._index()
+        return old
+
+    def rf_zone(self):
+        for zone in self.zones.values():
+            if zone.rf:
+                return zone
+        return next(iter(self.zones.values()))
+
+    def ips(self):
+        return {name: device.ip for name, device in self.devices.items()}
+
+    def macs(self):
+        return {name: device.mac for name, device in self.devices.items() if device.mac}
+
+    def stats(self):
+        return {zone.name: {"rf": zone.rf,
+                            "devices": {d.name: dict(d.options, kind=d.kind, ip=d.ip, mac=d.mac)
+                                        for d in zone.devices.values()}}
+                for zone in self.zones.values()}
+
+
+def default_registry(client_ips, client_macs, name="main"):
+    """One zone from client_ips.py: "PWM_CLIENT_IP" becomes device PWM of kind pwm."""
+    registry = ZoneRegistry()
+    zone = registry.add_zone(Zone(name, rf=True))
+    for key, ip in client_ips.items():
+        device = key[:-len("_CLIENT_IP")] if key.endswith("_CLIENT_IP") else key
+        registry.add_device(zone, device, device.lower(), ip, client_macs.get(device))
+    return registry
+
+
+def load_registry(path, client_ips, client_macs):
+    """
+    zones.json, if it exists, replaces the single zone from client_ips.py:
+        {"zones": {"bedroom": {"rf": true,
+                               "devices": {"PWM":  {"kind": "pwm", "ip": "192.168.50.60"},
+                                           "LAMP": {"kind": "lamp", "mac": "E0:5A:1B:79:8D:88"}}},
+                   "office":  {"settings": "settings.office.json",
+                               "devices": {"OFFICE_PWM": {"kind": "pwm", "ip": "192.168.50.61",
+                                                          "bits": 12, "response": "cie"}}}}}
+    Devices with a mac are re-resolved by discovery.py. Other keys are kept
+    as the device's options.
+    """
+    if not os.path.exists(path):
+        return default_registry(client_ips, client_macs)
+
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+        registry = ZoneRegistry()
+        for name, spec in config["zones"].items():
+            zone = registry.add_zone(Zone(name, rf=bool(spec.get("rf")), settings=spec.get("settings")))
+            for device, d in spec.get("devices", {}).items():
+                options = {k: v for k, v in d.items() if k not in ("kind", "ip", "mac")}
+                registry.add_device(zone, device, d["kind"], d.get("ip"), d.get("mac"), options)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        log(WARNING, f"Could not load zones from {path} ({e}), using client_ips.py")
+        return default_registry(client_ips, client_macs)
+
+    if not registry.zones:
+        log(WARNING, f"No zones in {path}, using client_ips.py")
+        return default_registry(client_ips, client_macs)
+    log(INFO, f"Loaded {len(registry.zones)} zones, {len(registry.devices)} devices from {path}")
+    return registry